@@ -0,0 +1,334 @@
+"""Benchmark every stage of the SHIS pipeline on a synthetic tree.
+
+Each stage is timed cold, on an empty ``thumb_dir``, and warm, on a
+``thumb_dir`` which is already up to date, just like a second run of
+SHIS. The server is then started and loaded by a pool of keep-alive
+clients. Results are written as JSON, and can be compared to the results
+of another run with ``--compare``.
+
+Example::
+
+    python benchmarks/run.py --files 100 --output before.json
+    python benchmarks/run.py --files 100 --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import http.client
+import statistics
+import subprocess
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+from shis import server
+from shis.index import ImageIndex
+from shis.scan import scan_tree
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Compute a percentile using the nearest-rank method.
+
+    :param values: the values to summarize.
+    :param pct: the percentile, between 0 and 100.
+    :return: the smallest value which is at least :attr:`pct` percent
+        of :attr:`values`.
+    """
+    values = sorted(values)
+    rank = max(int(len(values) * pct / 100 + 0.999999), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """Summarize a list of durations in seconds.
+
+    :param values: the durations to summarize.
+    :return: the count, mean and percentiles of :attr:`values`.
+    """
+    if not values:
+        return {'count': 0}
+    return {'count': len(values), 'mean': statistics.mean(values),
+            'p50': percentile(values, 50), 'p90': percentile(values, 90),
+            'p99': percentile(values, 99), 'max': max(values)}
+
+
+def timed(func: Callable, *args) -> Tuple[float, object]:
+    """Call :attr:`func` with the output of progress bars suppressed.
+
+    :param func: the function to call.
+    :param args: the arguments to call :attr:`func` with.
+    :return: a tuple of (seconds taken, value returned by :attr:`func`).
+    """
+    with open(os.devnull, 'w') as devnull, \
+         contextlib.redirect_stderr(devnull), contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        result = func(*args)
+        return time.perf_counter() - start, result
+
+
+def make_args(image_dir: str, thumb_dir: str, options: List[str]
+    ) -> argparse.Namespace:
+    """Parse the options of SHIS, as :func:`shis.server.main` would.
+
+    :param image_dir: the directory of the synthetic tree.
+    :param thumb_dir: the directory to generate the website in.
+    :param options: any additional command line options.
+    :return: preprocessed command line arguments.
+    """
+    args = server.make_parser().parse_args(
+        ['-d', image_dir, '--thumb-dir', thumb_dir, *options])
+    args.quiet = True
+    return server.preprocess_args(args)
+
+
+def run_pipeline(args: argparse.Namespace, paths: List=None) -> Dict:
+    """Time each stage of a single run of SHIS, without the worker pool.
+
+    Thumbnails are generated in this process one at a time, which
+    measures the cost of :func:`~shis.server.generate_thumbnail` itself
+    rather than the scheduling overhead of the pool.
+
+    :param args: preprocessed command line arguments.
+    :param paths: the paths to thumbnail, if :func:`process_paths`
+        returns none because they are already up to date.
+    :return: the timings of this run, and the paths that were processed.
+    """
+    index = ImageIndex(args.thumb_dir)
+    timings = {}
+    timings['scan_tree'], tree = timed(scan_tree, args)
+    timings['process_paths'], (new_paths, num_pages, _) = timed(
+        server.process_paths, args, tree, index)
+    # generate_albums is a generator, so consume all of it
+    timings['generate_albums'], _ = timed(lambda: list(
+        server.generate_albums(args, tree, index)))
+    timings['create_templates'], _ = timed(server.create_templates,
+        args, num_pages, tree, index)
+    paths = new_paths or paths or []
+    durations, results = [], []
+    for item in paths:
+        seconds, result = timed(server.generate_thumbnail, item, args)
+        durations.append(seconds)
+        results.append(result)
+    errors = [str(result) for result in results if not isinstance(result, str)]
+    timings['generate_thumbnail'] = summarize(durations)
+    server.record_thumbnails(tree, index, paths, results)
+    index.close()
+    return {'seconds': timings, 'errors': errors[:10], 'paths': paths}
+
+
+def collect_urls(thumb_dir: str) -> Dict[str, List[str]]:
+    """List the URLs of pages, thumbnails and static files of a website.
+
+    :param thumb_dir: the directory the website was generated in.
+    :return: the URLs of each kind of file.
+    """
+    kinds = {'page': 'html', 'thumbnail': 'small', 'static': 'static'}
+    urls = {kind: [] for kind in kinds}
+    for kind, subdir in kinds.items():
+        for root, _, names in os.walk(os.path.join(thumb_dir, subdir)):
+            for name in sorted(names):
+                if name.endswith(('.gz', '.br')):
+                    continue
+                rel_path = os.path.relpath(os.path.join(root, name), thumb_dir)
+                urls[kind].append('/' + urllib.parse.quote(rel_path))
+    return urls
+
+
+def load_server(port: int, urls: List[str], requests: int, clients: int,
+                seed: int) -> Dict:
+    """Request random URLs from the server using keep-alive connections.
+
+    :param port: the port of the server on localhost.
+    :param urls: the URLs to pick from.
+    :param requests: the total number of requests.
+    :param clients: the number of concurrent connections.
+    :param seed: the seed used to pick URLs.
+    :return: the throughput, latencies and status codes of the requests.
+    """
+    rng = random.Random(seed)
+    plan = [rng.choice(urls) for _ in range(requests)]
+    shares = [plan[idx::clients] for idx in range(clients)]
+
+    def client(share: List[str]) -> Tuple[List[float], Dict[int, int]]:
+        conn = http.client.HTTPConnection('localhost', port, timeout=30)
+        latencies, statuses = [], {}
+        for url in share:
+            start = time.perf_counter()
+            conn.request('GET', url, headers={'Accept-Encoding': 'gzip, br'})
+            response = conn.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+        conn.close()
+        return latencies, statuses
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        outcomes = list(pool.map(client, shares))
+    elapsed = time.perf_counter() - start
+    latencies = [value for outcome in outcomes for value in outcome[0]]
+    statuses = {}
+    for _, counts in outcomes:
+        for status, count in counts.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    return {'requests_per_second': len(latencies) / elapsed,
+            'latency': summarize(latencies), 'status': statuses}
+
+
+def run_server(args: argparse.Namespace, options: argparse.Namespace) -> Dict:
+    """Benchmark the server on the generated website.
+
+    Every URL is first requested once, which is the cold pass. The warm
+    pass then makes :attr:`options.requests` requests for random URLs.
+
+    :param args: preprocessed command line arguments of SHIS.
+    :param options: the options of the benchmark.
+    :return: the results of the cold and warm passes.
+    """
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        httpd = server.start_server(args)
+    try:
+        port = httpd.socket.getsockname()[1]
+        urls = collect_urls(args.thumb_dir)
+        everything = [url for kind in urls.values() for url in kind]
+        results = {'cold': load_server(port, everything, len(everything),
+                                       options.clients, options.seed)}
+        results['cold']['requests'] = len(everything)
+        results['warm'] = load_server(port, everything, options.requests,
+                                      options.clients, options.seed)
+        for kind, kind_urls in urls.items():
+            if kind_urls:
+                results[kind] = load_server(port, kind_urls,
+                    options.requests // 4, options.clients, options.seed)
+    finally:
+        httpd.shutdown()
+        httpd.server_close() if hasattr(httpd, 'server_close') else None
+    return results
+
+
+def environment() -> Dict:
+    """Describe the machine and the version of the code being benchmarked.
+
+    :return: a description of the environment.
+    """
+    from PIL import __version__ as pillow_version
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': platform.python_version(), 'pillow': pillow_version,
+            'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+
+def compare(old: Dict, new: Dict, prefix: str='') -> List[Tuple[str, float, float]]:
+    """Pair up the numbers of two results.
+
+    :param old: the results of a previous run.
+    :param new: the results of this run.
+    :param prefix: the path of the results being compared.
+    :return: a list of (path, old value, new value).
+    """
+    pairs = []
+    for key, value in new.items():
+        path = f'{prefix}.{key}' if prefix else key
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            pairs.extend(compare(old[key], value, path))
+        elif (isinstance(value, (int, float)) and not isinstance(value, bool)
+              and isinstance(old.get(key), (int, float))):
+            pairs.append((path, old[key], value))
+    return pairs
+
+
+def make_parser() -> argparse.ArgumentParser:
+    """Create a parser for the options of the benchmark.
+
+    :return: a parser for the options of the benchmark.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--image-dir', default=None, metavar='DIR',
+        help='where to keep the synthetic tree (default: a temporary directory)')
+    synthetic.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of warm runs, the median is reported (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=2000,
+        help='number of requests of the warm server pass (default: %(default)s)')
+    parser.add_argument('--clients', type=int, default=8,
+        help='number of concurrent connections (default: %(default)s)')
+    parser.add_argument('--shis', default='', metavar='OPTIONS',
+        help='extra options for shis, such as "--pack --engine asyncio"')
+    parser.add_argument('--no-server', action='store_true',
+        help='skip the server benchmark')
+    parser.add_argument('-o', '--output', default=None, metavar='FILE',
+        help='file to write the results to (default: standard output)')
+    parser.add_argument('--compare', default=None, metavar='FILE',
+        help='print how the results changed since a previous run')
+    return parser
+
+
+def main(options: argparse.Namespace) -> Dict:
+    """Generate a synthetic tree and benchmark SHIS on it.
+
+    :param options: the options of the benchmark.
+    :return: the results of the benchmark.
+    """
+    workdir = tempfile.mkdtemp(prefix='shis-bench-')
+    try:
+        image_dir = options.image_dir or os.path.join(workdir, 'images')
+        thumb_dir = os.path.join(workdir, 'shis')
+        seconds, manifest = timed(synthetic.generate, image_dir,
+            options.depth, options.fanout, options.files, options.sizes,
+            options.formats, options.seed)
+        manifest['seconds'] = seconds
+        args = make_args(image_dir, thumb_dir, options.shis.split())
+
+        cold = run_pipeline(args)
+        warm_runs = [run_pipeline(args, cold['paths'])
+                     for _ in range(max(options.repeat, 1))]
+        stages = {}
+        for stage, value in cold['seconds'].items():
+            warm = [run['seconds'][stage] for run in warm_runs]
+            if isinstance(value, dict):
+                stages[stage] = {'cold': value,
+                                 'warm': min(warm, key=lambda s: s.get('mean', 0))}
+            else:
+                stages[stage] = {'cold': value, 'warm': statistics.median(warm)}
+        results = {'environment': environment(), 'tree': manifest,
+                   'options': options.shis, 'stages': stages,
+                   'errors': cold['errors']}
+        if not options.no_server:
+            results['server'] = run_server(args, options)
+    finally:
+        shutil.rmtree(workdir)
+    return results
+
+
+if __name__ == '__main__':
+    options = make_parser().parse_args()
+    results = main(options)
+    text = json.dumps(results, indent=2)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare) as f:
+            previous = json.load(f)
+        for path, old, new in compare(previous, results):
+            change = f'{(new - old) / old * 100:+.1f}%' if old else 'n/a'
+            print(f'{path:<60} {old:>12.4g} {new:>12.4g} {change:>9}',
+                  file=sys.stderr)
@@ -0,0 +1,157 @@
+"""Generate a deterministic tree of synthetic images for benchmarking SHIS.
+
+The tree has :attr:`depth` levels of directories, each of which contains
+:attr:`fanout` subdirectories and :attr:`files` images. Image sizes and
+formats are picked in turn from the given lists, and the contents of each
+image are derived from a seeded random generator, so the same parameters
+always produce the same tree.
+
+Example::
+
+    python benchmarks/synthetic.py /tmp/images --depth 2 --fanout 3 --files 50
+"""
+
+import os
+import json
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+from PIL import Image
+
+# Pillow format and save options for each extension
+FORMATS = {
+    'jpg': ('JPEG', {'quality': 90}),
+    'png': ('PNG', {}),
+    'webp': ('WEBP', {'quality': 90}),
+    'tiff': ('TIFF', {}),
+}
+MANIFEST = 'synthetic.json'
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    """Parse an image size such as ``1024x768``.
+
+    :param value: the width and height separated by ``x``.
+    :return: a tuple of (width, height).
+    :raises argparse.ArgumentTypeError: if :attr:`value` is not a size.
+    """
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return width, height
+
+
+def make_image(rng: random.Random, size: Tuple[int, int]) -> Image.Image:
+    """Paint an image out of a randomly rotated gradient for each band.
+
+    Gradients are cheap to create but still take some work to encode and
+    decode, unlike images of a single color.
+
+    :param rng: the random generator to draw from.
+    :param size: the width and height of the image.
+    :return: an RGB image.
+    """
+    bands = []
+    for _ in range(3):
+        gradient = Image.linear_gradient('L').rotate(rng.uniform(0, 360))
+        bands.append(gradient.resize(size, Image.BILINEAR))
+    return Image.merge('RGB', bands)
+
+
+def folders(root: str, depth: int, fanout: int) -> List[str]:
+    """List the directories of the tree, top-down.
+
+    :param root: the root of the tree.
+    :param depth: the number of levels below :attr:`root`.
+    :param fanout: the number of subdirectories of each directory.
+    :return: the paths of all directories, including :attr:`root`.
+    """
+    paths, level = [root], [root]
+    for _ in range(depth):
+        level = [os.path.join(parent, f'album{idx:02d}')
+                 for parent in level for idx in range(fanout)]
+        paths.extend(level)
+    return paths
+
+
+def generate(root: str, depth: int=1, fanout: int=4, files: int=50,
+             sizes: List[Tuple[int, int]]=((1600, 1200),),
+             formats: List[str]=('jpg',), seed: int=0) -> Dict:
+    """Create a synthetic tree, unless it already exists.
+
+    The parameters are saved to :data:`MANIFEST` inside :attr:`root`, and
+    the tree is reused as is when they match the existing manifest.
+
+    :param root: the directory to create the tree in.
+    :param depth: the number of levels of subdirectories.
+    :param fanout: the number of subdirectories of each directory.
+    :param files: the number of images in each directory.
+    :param sizes: the sizes of images, used in turn.
+    :param formats: the extensions of images, used in turn.
+    :param seed: the seed of the random generator.
+    :return: the manifest of the tree.
+    """
+    manifest = {'depth': depth, 'fanout': fanout, 'files': files,
+                'sizes': [list(size) for size in sizes],
+                'formats': list(formats), 'seed': seed}
+    manifest_path = os.path.join(root, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            existing = json.load(f)
+        if {k: existing.get(k) for k in manifest} == manifest:
+            return existing
+    except (OSError, ValueError):
+        pass
+    if os.path.exists(root) and os.listdir(root):
+        raise SystemExit(f'Refusing to overwrite non-empty directory: {root}')
+
+    rng = random.Random(seed)
+    count, total_bytes = 0, 0
+    for folder in folders(root, depth, fanout):
+        os.makedirs(folder, exist_ok=True)
+        for idx in range(files):
+            size = sizes[count % len(sizes)]
+            ext = formats[count % len(formats)]
+            image_format, options = FORMATS[ext]
+            path = os.path.join(folder, f'image{idx:05d}.{ext}')
+            im = make_image(rng, size)
+            im.save(path, image_format, **options)
+            total_bytes += os.path.getsize(path)
+            count += 1
+    manifest.update(images=count, bytes=total_bytes)
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the parameters of :func:`generate` to :attr:`parser`.
+
+    :param parser: the parser to add arguments to.
+    """
+    parser.add_argument('--depth', type=int, default=1,
+        help='levels of subdirectories (default: %(default)s)')
+    parser.add_argument('--fanout', type=int, default=4,
+        help='subdirectories per directory (default: %(default)s)')
+    parser.add_argument('--files', type=int, default=50,
+        help='images per directory (default: %(default)s)')
+    parser.add_argument('--sizes', type=parse_size, nargs='+',
+        default=[(1600, 1200)], metavar='WxH',
+        help='image sizes, used in turn (default: 1600x1200)')
+    parser.add_argument('--formats', nargs='+', default=['jpg'],
+        choices=sorted(FORMATS),
+        help='image formats, used in turn (default: jpg)')
+    parser.add_argument('--seed', type=int, default=0,
+        help='seed of the random generator (default: %(default)s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('root', help='directory to create the tree in')
+    add_arguments(parser)
+    args = parser.parse_args()
+    manifest = generate(args.root, args.depth, args.fanout, args.files,
+                        args.sizes, args.formats, args.seed)
+    print(json.dumps(manifest, indent=2))
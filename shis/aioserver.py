@@ -0,0 +1,192 @@
+import io
+import time
+import socket
+import asyncio
+import argparse
+import contextlib
+import email.utils
+import http.client
+import threading
+from functools import partial
+from http import HTTPStatus
+from typing import Tuple
+
+from shis.response import Resolver, Response
+from shis.utils import announce, make_resolver, start_httpd
+
+
+class AsyncHTTPServer:
+    """An HTTP server built on ``asyncio`` which serves a :class:`Resolver`.
+
+    All connections are handled by a single event loop running in its own
+    thread, instead of one thread per connection. Files are sent with
+    ``loop.sendfile``, which uses ``os.sendfile`` where available so that
+    file contents are copied by the kernel and never pass through Python.
+    The interface mirrors ``HTTPServer``, so :func:`~shis.server.main` can
+    use either engine.
+
+    :param address: the address to bind to.
+    :param resolver: the resolver which produces responses.
+    :param family: the address family of the socket.
+    :raises OSError: if the socket could not be bound.
+    """
+
+    timeout = 60
+    max_header_size = 64 * 1024
+
+    def __init__(self, address: Tuple[str, int], resolver: Resolver,
+                 family: socket.AddressFamily=socket.AF_INET):
+        self.resolver = resolver
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                # suppress exception when protocol is IPv4
+                with contextlib.suppress(Exception):
+                    self.socket.setsockopt(
+                        socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+            self.socket.bind(address)
+            self.socket.listen(128)
+            self.socket.setblocking(False)
+        except OSError:
+            self.socket.close()
+            raise
+        self.loop = asyncio.new_event_loop()
+        self._stopped = threading.Event()
+
+    def serve_forever(self) -> None:
+        """Run the event loop until :meth:`shutdown` is called."""
+        loop = self.loop
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(asyncio.start_server(
+                self.handle, sock=self.socket, limit=self.max_header_size))
+            loop.run_forever()
+            server.close()
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            loop.run_until_complete(server.wait_closed())
+        finally:
+            loop.close()
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        """Stop the event loop and wait for :meth:`serve_forever` to return."""
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._stopped.wait()
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter) -> None:
+        """Serve requests on a connection until it is closed."""
+        # asyncio only disables Nagle's algorithm for sockets created with
+        # IPPROTO_TCP, and headers and body are written separately
+        with contextlib.suppress(OSError):
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while await self.handle_one_request(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError):
+            pass
+        except asyncio.CancelledError:
+            # Connections still open on shutdown, end quietly since some
+            # versions of asyncio log the cancellation as an error
+            pass
+        finally:
+            writer.close()
+
+    async def handle_one_request(self, reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> bool:
+        """Read a single request and send the response.
+
+        :return: ``True`` if the connection should be kept alive.
+        """
+        head = await asyncio.wait_for(
+            reader.readuntil(b'\r\n\r\n'), self.timeout)
+        request_line, _, head = head.partition(b'\r\n')
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+            headers = http.client.parse_headers(io.BytesIO(head))
+            length = int(headers.get('Content-Length', 0))
+        except (ValueError, http.client.HTTPException):
+            await self.send(writer, 'GET', self.resolver.error(
+                HTTPStatus.BAD_REQUEST), False)
+            return False
+        if length:
+            await reader.readexactly(length)
+        connection = headers.get('Connection', '').lower()
+        keep_alive = (connection == 'keep-alive' or
+            (version == 'HTTP/1.1' and connection != 'close'))
+        if method not in ('GET', 'HEAD'):
+            response = self.resolver.error(HTTPStatus.NOT_IMPLEMENTED)
+        else:
+            response = await self.resolve(target, headers)
+        await self.send(writer, method, response, keep_alive)
+        return keep_alive
+
+    async def resolve(self, target: str,
+                      headers: http.client.HTTPMessage) -> Response:
+        """Produce the response to a request using :attr:`resolver`.
+
+        :attr:`resolver.on_demand` may take a while to generate a thumbnail,
+        and :meth:`resolver.exists` and :meth:`resolver.respond` touch the
+        filesystem, so they are run in a separate thread to keep the event
+        loop responsive.
+        """
+        start = time.perf_counter()
+        resolver = self.resolver
+        path = resolver.translate_path(target)
+        if resolver.on_view is not None:
+            resolver.on_view(path)
+        if resolver.on_demand is not None:
+            if not await self.loop.run_in_executor(None, resolver.exists, path):
+                await self.loop.run_in_executor(None, resolver.on_demand, path)
+        response = await self.loop.run_in_executor(
+            None, resolver.respond, target, path, headers)
+        resolver.track(response, start)
+        return response
+
+    async def send(self, writer: asyncio.StreamWriter, method: str,
+                   response: Response, keep_alive: bool) -> None:
+        """Write a response to the connection."""
+        try:
+            lines = [f'HTTP/1.1 {response.status.value} {response.status.phrase}',
+                     'Server: shis',
+                     f'Date: {email.utils.formatdate(usegmt=True)}']
+            lines.extend(f'{name}: {value}' for name, value in response.headers)
+            if not keep_alive:
+                lines.append('Connection: close')
+            lines.extend(['', ''])
+            writer.write('\r\n'.join(lines).encode('latin-1', 'strict'))
+            for segment in response.segments if method != 'HEAD' else []:
+                if not isinstance(segment, tuple):
+                    writer.write(segment)
+                else:
+                    await self.loop.sendfile(writer.transport, response.file,
+                        *segment)
+            await writer.drain()
+        finally:
+            response.close()
+
+
+def start_server_async(args: argparse.Namespace) -> AsyncHTTPServer:
+    """Start an :class:`AsyncHTTPServer` as a separate thread.
+
+    :param args: preprocessed command line arguments.
+    """
+    resolver = make_resolver(args)
+    family, host = socket.AF_INET, ''
+    if socket.has_ipv6 and socket.has_dualstack_ipv6():
+        family, host = socket.AF_INET6, '::'
+    server_class = partial(AsyncHTTPServer, family=family)
+    server_address = (host, args.port or 7447)
+    httpd = start_httpd(server_class, server_address, resolver, args)
+
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    announce(httpd, args, ' using asyncio')
+
+    return httpd
@@ -0,0 +1,80 @@
+import os
+import hashlib
+from typing import Dict, Iterable, List
+
+from shis.index import ImageIndex
+from shis.scan import Tree
+
+
+def file_digest(path: str, chunk_size: int=1 << 20) -> str:
+    """Compute a digest of the contents of a file.
+
+    :param path: the path of the file.
+    :param chunk_size: the number of bytes to read at a time.
+    :return: the hex digest of the file.
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def find_duplicates(tree: Tree, index: ImageIndex,
+                    paths: Iterable[str]) -> Dict[str, str]:
+    """Find images in :attr:`paths` whose contents exist elsewhere in the tree.
+
+    Only images with the same size as one of :attr:`paths` can be
+    duplicates, so every other image is ruled out using the ``stat``
+    cached by :func:`~shis.scan.scan_tree`. The remaining candidates are
+    hashed with :func:`file_digest`, and their digests are stored in
+    :attr:`index` so that unchanged images are never hashed again.
+
+    Each set of identical images has a single canonical image. An image
+    whose thumbnails are already up to date is preferred, since its
+    thumbnails can be reused right away. Otherwise, the first image in
+    the order of the tree which needs thumbnails is picked, so the choice
+    is stable across runs.
+
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param paths: the absolute paths of images which need thumbnails.
+    :return: a mapping from each duplicate in :attr:`paths` to the
+        absolute path of its canonical image.
+    """
+    paths = set(paths)
+    sizes = {tree.stat(path).st_size for path in paths} - {0}
+    candidates = {}  # type: Dict[int, List[str]]
+    for folder in tree:
+        for name, entry in folder.files.items():
+            size = entry.stat().st_size
+            if size in sizes:
+                candidates.setdefault(size, []).append(
+                    os.path.join(folder.path, name))
+
+    duplicates = {}
+    for group in candidates.values():
+        if len(group) < 2:
+            continue
+        digests = {}  # type: Dict[str, List[str]]
+        for path in group:
+            stat = tree.stat(path)
+            digest = index.digest(path, stat)
+            if digest is None:
+                try:
+                    digest = file_digest(path)
+                except OSError:
+                    continue
+                index.set_digest(path, stat, digest)
+            digests.setdefault(digest, []).append(path)
+        for same in digests.values():
+            needed = [path for path in same if path in paths]
+            if not needed or len(same) < 2:
+                continue
+            current = [path for path in same if path not in paths and
+                       index.has_thumb(path, tree.stat(path))]
+            canonical = (current or needed)[0]
+            duplicates.update((path, canonical) for path in needed
+                              if path != canonical)
+    index.commit()
+    return duplicates
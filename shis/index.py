@@ -0,0 +1,269 @@
+import os
+import sqlite3
+from typing import List, NamedTuple, Optional, Tuple
+
+from shis.stats import Stats
+
+
+class Entry(NamedTuple):
+    """A single row of the :class:`ImageIndex`.
+
+    :meta private:
+    """
+    mtime: int
+    size: int
+    width: Optional[int]
+    height: Optional[int]
+    thumb: Optional[int]
+    placeholder: Optional[str]
+    digest: Optional[str]
+
+
+class ImageIndex:
+    """A persistent index of image metadata stored inside :attr:`thumb_dir`.
+
+    The index is an SQLite database keyed by the absolute path of each
+    original image. Every row remembers the ``mtime`` and ``size`` of the
+    image at the time it was indexed, along with its dimensions, the
+    ``mtime`` of the image that was last thumbnailed, the placeholder
+    created along with its thumbnails and a digest of its contents, which
+    is only computed when looking for duplicates. A row is only trusted
+    as long as ``mtime`` and ``size`` match a fresh ``stat`` of the image,
+    which means unchanged images never have to be opened again.
+
+    The index also remembers a digest of every generated album and page,
+    so that :func:`~shis.server.create_templates` only renders what changed.
+
+    Reading the headers of images is timed in :attr:`stats`.
+
+    The database is opened lazily, so it is safe to create an instance
+    before :attr:`thumb_dir` is cleaned up by :func:`process_paths`.
+
+    :param thumb_dir: the path to the generated website.
+    """
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, '
+        'mtime INTEGER, size INTEGER, width INTEGER, height INTEGER, '
+        'thumb INTEGER, placeholder TEXT, digest TEXT)',
+        'CREATE TABLE IF NOT EXISTS albums (url TEXT PRIMARY KEY, '
+        'digest TEXT, pages INTEGER)',
+        'CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, '
+        'album TEXT, digest TEXT)',
+        'CREATE INDEX IF NOT EXISTS pages_album ON pages (album)',
+    ]
+
+    # Columns added to the images table after it was first released
+    COLUMNS = [('placeholder', 'TEXT'), ('digest', 'TEXT')]
+    # Name of the database, SQLite keeps its journals next to it
+    NAME = 'index.db'
+
+    def __init__(self, thumb_dir: str):
+        self.path = os.path.join(thumb_dir, self.NAME)
+        self.stats = Stats()
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """A lazily opened connection to the underlying database."""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+            columns = [row[1] for row in
+                       self._conn.execute('PRAGMA table_info(images)')]
+            for name, kind in self.COLUMNS:
+                if name not in columns:
+                    # Upgrade indexes created before the column was added
+                    self._conn.execute(
+                        f'ALTER TABLE images ADD COLUMN {name} {kind}')
+        return self._conn
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[Entry]:
+        """Fetch the entry for :attr:`path` if it is still up to date.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: the indexed entry, or ``None`` if it is missing or stale.
+        """
+        row = self.conn.execute('SELECT mtime, size, width, height, thumb, '
+            'placeholder, digest FROM images WHERE path = ?', (path,)).fetchone()
+        if row is None:
+            return None
+        entry = Entry(*row)
+        if entry.mtime != stat.st_mtime_ns or entry.size != stat.st_size:
+            return None
+        return entry
+
+    def dims(self, path: str, stat: os.stat_result) -> Tuple[int, int]:
+        """Return the dimensions of an image, reading its header if needed.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: a tuple containing the width and height of the image.
+        :raises ValueError: if the image header could not be parsed.
+        """
+        entry = self.get(path, stat)
+        if entry is not None and entry.width is not None:
+            return entry.width, entry.height
+        import imagesize
+        with self.stats.stage('read_headers'):
+            width, height = imagesize.get(path)
+        if width < 0 or height < 0:
+            raise ValueError(f'Could not determine image size: {path}')
+        self._put(path, self._entry(path, stat)._replace(
+            width=width, height=height))
+        return width, height
+
+    def placeholder(self, path: str, stat: os.stat_result) -> Optional[str]:
+        """Return the placeholder of an image, if its thumbnails are current.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: a ``data:`` URI, or ``None`` if there is no placeholder.
+        """
+        entry = self.get(path, stat)
+        if entry is None or entry.thumb != stat.st_mtime_ns:
+            return None
+        return entry.placeholder
+
+    def has_thumb(self, path: str, stat: os.stat_result) -> bool:
+        """Check whether the thumbnails of an image are known to be current.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: ``True`` if thumbnails and a placeholder were generated
+            for this exact version of the image, ``False`` otherwise.
+        """
+        return self.placeholder(path, stat) is not None
+
+    def set_thumb(self, path: str, stat: os.stat_result,
+                  placeholder: str) -> None:
+        """Record that thumbnails were generated for an image.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :param placeholder: the placeholder of the image, see
+            :func:`~shis.server.placeholder`.
+        """
+        self._put(path, self._entry(path, stat)._replace(
+            thumb=stat.st_mtime_ns, placeholder=placeholder))
+
+    def digest(self, path: str, stat: os.stat_result) -> Optional[str]:
+        """Return the digest of the contents of an image, if it is known.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: a hex digest, or ``None`` if it was never computed.
+        """
+        entry = self.get(path, stat)
+        return entry.digest if entry is not None else None
+
+    def set_digest(self, path: str, stat: os.stat_result, digest: str) -> None:
+        """Record the digest of the contents of an image.
+
+        :param path: the absolute path of the original image.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :param digest: a hex digest, see :func:`~shis.dedup.file_digest`.
+        """
+        self._put(path, self._entry(path, stat)._replace(digest=digest))
+
+    def remove(self, path: str) -> None:
+        """Forget about an image which no longer exists.
+
+        :param path: the absolute path of the original image.
+        """
+        self.conn.execute('DELETE FROM images WHERE path = ?', (path,))
+
+    def album(self, url: str) -> Tuple[Optional[str], int]:
+        """Fetch the digest and number of pages of a generated album.
+
+        :param url: the URL of the first page of the album.
+        :return: a tuple of (digest, pages), or ``(None, 0)`` if unknown.
+        """
+        row = self.conn.execute('SELECT digest, pages FROM albums '
+            'WHERE url = ?', (url,)).fetchone()
+        return tuple(row) if row else (None, 0)
+
+    def albums(self) -> List[str]:
+        """List the URLs of all generated albums."""
+        return [url for url, in self.conn.execute('SELECT url FROM albums')]
+
+    def set_album(self, url: str, digest: str, pages: int) -> None:
+        """Record the digest and number of pages of a generated album.
+
+        :param url: the URL of the first page of the album.
+        :param digest: the digest from :func:`~shis.server.album_digest`.
+        :param pages: the number of pages in the album.
+        """
+        self.conn.execute('INSERT OR REPLACE INTO albums VALUES (?, ?, ?)',
+            (url, digest, pages))
+
+    def remove_album(self, url: str) -> None:
+        """Forget about an album and all of its pages.
+
+        :param url: the URL of the first page of the album.
+        """
+        self.conn.execute('DELETE FROM albums WHERE url = ?', (url,))
+        self.conn.execute('DELETE FROM pages WHERE album = ?', (url,))
+
+    def page(self, url: str) -> Optional[str]:
+        """Fetch the digest of a generated page.
+
+        :param url: the URL of the page.
+        :return: the digest of the page, or ``None`` if unknown.
+        """
+        row = self.conn.execute('SELECT digest FROM pages WHERE url = ?',
+            (url,)).fetchone()
+        return row[0] if row else None
+
+    def album_pages(self, url: str) -> List[str]:
+        """List the URLs of all generated pages of an album.
+
+        :param url: the URL of the first page of the album.
+        """
+        return [page for page, in self.conn.execute(
+            'SELECT url FROM pages WHERE album = ?', (url,))]
+
+    def set_page(self, url: str, album: str, digest: str) -> None:
+        """Record the digest of a generated page.
+
+        :param url: the URL of the page.
+        :param album: the URL of the first page of the album.
+        :param digest: a digest of the contents of the page.
+        """
+        self.conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)',
+            (url, album, digest))
+
+    def remove_page(self, url: str) -> None:
+        """Forget about a generated page.
+
+        :param url: the URL of the page.
+        """
+        self.conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+
+    def commit(self) -> None:
+        """Flush pending changes to disk."""
+        if self._conn is not None:
+            self._conn.commit()
+
+    def close(self) -> None:
+        """Commit pending changes and close the database."""
+        if self._conn is not None:
+            self._conn.commit()
+            self._conn.close()
+            self._conn = None
+
+    def _entry(self, path: str, stat: os.stat_result) -> Entry:
+        entry = self.get(path, stat)
+        if entry is None:
+            entry = Entry(stat.st_mtime_ns, stat.st_size,
+                          None, None, None, None, None)
+        return entry
+
+    def _put(self, path: str, entry: Entry) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO images VALUES '
+            '(?, ?, ?, ?, ?, ?, ?, ?)', (path, *entry))
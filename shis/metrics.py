@@ -0,0 +1,87 @@
+import bisect
+import threading
+from typing import Callable, Dict, Tuple, Union
+
+Number = Union[int, float]
+
+
+class Metrics:
+    """Counters describing the requests served by the server.
+
+    Every response is recorded by :meth:`observe` once it has been sent,
+    and :meth:`render` produces the text format understood by Prometheus,
+    which the server exposes at ``/metrics``. Other parts of SHIS can
+    publish their own values with :meth:`register`, which are only read
+    when the metrics are rendered.
+    """
+
+    # Upper bounds of the buckets of the latency histogram, in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}  # type: Dict[int, int]
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.seconds = 0.0
+        self.bytes = 0
+        self.collectors = {}  # type: Dict[str, Tuple[str, str, Callable[[], Number]]]
+
+    def observe(self, status: int, seconds: float, size: int=0) -> None:
+        """Record a response which has been sent.
+
+        :param status: the HTTP status of the response.
+        :param seconds: the time taken to produce and send the response.
+        :param size: the size of the content of the response in bytes.
+        """
+        with self.lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.buckets[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            self.seconds += seconds
+            self.bytes += size
+
+    def register(self, name: str, kind: str, help_text: str,
+                 collect: Callable[[], Number]) -> None:
+        """Publish a value which is computed whenever metrics are rendered.
+
+        :param name: the name of the metric.
+        :param kind: the type of the metric, either ``gauge`` or ``counter``.
+        :param help_text: a description of the metric.
+        :param collect: a function returning the current value.
+        """
+        self.collectors[name] = (kind, help_text, collect)
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format.
+
+        :return: the text to serve at ``/metrics``.
+        """
+        with self.lock:
+            requests = sorted(self.requests.items())
+            buckets, seconds, size = list(self.buckets), self.seconds, self.bytes
+        lines = [
+            '# HELP shis_http_requests_total Requests served, by status code.',
+            '# TYPE shis_http_requests_total counter',
+        ]
+        lines.extend(f'shis_http_requests_total{{code="{status}"}} {count}'
+                     for status, count in requests)
+        lines.extend([
+            '# HELP shis_http_request_duration_seconds Time taken to serve requests.',
+            '# TYPE shis_http_request_duration_seconds histogram',
+        ])
+        total = 0
+        for bound, count in zip([*map(str, self.BUCKETS), '+Inf'], buckets):
+            total += count
+            lines.append(f'shis_http_request_duration_seconds_bucket'
+                         f'{{le="{bound}"}} {total}')
+        lines.extend([
+            f'shis_http_request_duration_seconds_sum {seconds}',
+            f'shis_http_request_duration_seconds_count {total}',
+            '# HELP shis_http_response_bytes_total Bytes of content served.',
+            '# TYPE shis_http_response_bytes_total counter',
+            f'shis_http_response_bytes_total {size}',
+        ])
+        for name, (kind, help_text, collect) in sorted(self.collectors.items()):
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {kind}',
+                          f'{name} {collect()}'])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,341 @@
+import os
+import json
+import mmap
+import threading
+import contextlib
+from typing import (BinaryIO, Dict, Iterator, Iterable, List, NamedTuple,
+                    Optional, Set, Tuple)
+
+try:
+    import fcntl
+except ImportError:
+    # Packs are written under an advisory lock, which needs POSIX
+    fcntl = None
+
+# Whether packs can be used on this platform
+SUPPORTED = fcntl is not None
+
+
+class PackEntry(NamedTuple):
+    """The location of a single thumbnail inside a pack file.
+
+    :meta private:
+    """
+    offset: int
+    length: int
+    mtime: int
+
+
+class Pack(NamedTuple):
+    """The parsed index of the pack file of an album.
+
+    :meta private:
+    """
+    key: Tuple[int, int]
+    parsed: int
+    name: str
+    entries: Dict[str, PackEntry]
+    dead: int
+
+
+class PackStore:
+    """Store the thumbnails of each album in a single pack file.
+
+    Instead of one file per thumbnail and size, every album gets a
+    directory inside ``packs`` which contains a pack file and an index.
+    Thumbnails are appended to the pack file, and a line is appended to
+    the index with the offset, length and ``mtime`` of each thumbnail.
+    The paths of thumbnails do not change: ``small/album/image.jpg`` is
+    stored under the key ``small/image.jpg`` of the pack of ``album``.
+
+    Appends are serialized with an exclusive ``flock`` on the index, so
+    thumbnails may be written by several processes at once. Replaced and
+    removed thumbnails leave garbage in the pack file, which is reclaimed
+    by :meth:`compact` once it takes up more space than the live data.
+    Compacting writes a new pack file under a new name, so readers which
+    are still using the old pack file are never disturbed.
+
+    Readers keep each pack file memory mapped, and :meth:`read` returns
+    slices of the map without copying. Indexes are reloaded only when
+    their file changes, and new lines are parsed incrementally.
+
+    Use :func:`pack_store` to share a store within a process.
+
+    :param thumb_dir: the path to the generated website.
+    """
+
+    INDEX = 'thumbs.idx'
+
+    def __init__(self, thumb_dir: str):
+        self.thumb_dir = thumb_dir
+        self.root = os.path.join(thumb_dir, 'packs')
+        self.lock = threading.Lock()
+        self.packs = {}  # type: Dict[str, Pack]
+        self.maps = {}  # type: Dict[str, Tuple[mmap.mmap, int]]
+
+    def locate(self, path: str) -> Optional[Tuple[str, str]]:
+        """Find where a thumbnail is stored.
+
+        :param path: the absolute path of a thumbnail.
+        :return: a tuple of (the pack directory of the album, the key of
+            the thumbnail), or ``None`` if :attr:`path` is not a thumbnail.
+        """
+        parts = os.path.relpath(path, self.thumb_dir).split(os.path.sep)
+        if parts[0] in ('small', 'large') and len(parts) > 1:
+            album, key = parts[1:-1], f'{parts[0]}/{parts[-1]}'
+        elif parts[0] == 'sizes' and len(parts) > 2 and parts[1].isdigit():
+            album, key = parts[2:-1], f'sizes/{parts[1]}/{parts[-1]}'
+        else:
+            return None
+        if os.pardir in album:
+            return None
+        return os.path.join(self.root, *album), key
+
+    def get(self, path: str) -> Optional[PackEntry]:
+        """Look up a thumbnail.
+
+        :param path: the absolute path of a thumbnail.
+        :return: the location of the thumbnail, or ``None`` if it is missing.
+        """
+        location = self.locate(path)
+        if location is None:
+            return None
+        pack = self.load(location[0])
+        return pack.entries.get(location[1]) if pack else None
+
+    def names(self, path: str) -> Set[str]:
+        """List the names of the thumbnails stored for a directory.
+
+        :param path: the absolute path of a thumbnail directory, such as
+            ``small/album``.
+        :return: the names of the thumbnails inside :attr:`path`.
+        """
+        location = self.locate(os.path.join(path, '_'))
+        if location is None:
+            return set()
+        pack = self.load(location[0])
+        prefix = location[1][:-1]
+        with self.lock:
+            return {key[len(prefix):] for key in (pack.entries if pack else [])
+                    if key.startswith(prefix) and '/' not in key[len(prefix):]}
+
+    def read(self, path: str) -> Optional[Tuple[memoryview, PackEntry, int]]:
+        """Read a thumbnail out of the memory mapped pack file.
+
+        :param path: the absolute path of a thumbnail.
+        :return: a tuple of (data, entry, inode), where data is a view of
+            the pack file and inode identifies the pack file, or ``None``
+            if the thumbnail is missing.
+        """
+        location = self.locate(path)
+        if location is None:
+            return None
+        pack = self.load(location[0])
+        entry = pack.entries.get(location[1]) if pack else None
+        if entry is None:
+            return None
+        pack_path = os.path.join(location[0], pack.name)
+        end = entry.offset + entry.length
+        with self.lock:
+            data, inode = self.maps.get(pack_path, (b'', 0))
+            if len(data) < end:
+                # Map the pack file again, it has grown since it was mapped
+                try:
+                    with open(pack_path, 'rb') as f:
+                        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                        inode = os.fstat(f.fileno()).st_ino
+                except (OSError, ValueError):
+                    return None
+                self.maps[pack_path] = (data, inode)
+                # Older pack files of this album were removed by compact()
+                self._unmap(location[0], keep=pack_path)
+        if len(data) < end:
+            return None
+        return memoryview(data)[entry.offset:end], entry, inode
+
+    def write(self, path: str, data: bytes) -> None:
+        """Append a thumbnail to the pack file of its album.
+
+        :param path: the absolute path of a thumbnail.
+        :param data: the encoded thumbnail.
+        :raises ValueError: if :attr:`path` is not a thumbnail.
+        """
+        location = self.locate(path)
+        if location is None:
+            raise ValueError(f'Not a thumbnail: {path}')
+        directory, key = location
+        with self.locked(directory) as (index_file, pack_name):
+            with open(os.path.join(directory, pack_name), 'ab') as f:
+                offset = f.seek(0, os.SEEK_END)
+                f.write(data)
+            mtime = os.stat(os.path.join(directory, pack_name)).st_mtime_ns
+            line = json.dumps([key, offset, len(data), mtime])
+            index_file.write(f'{line}\n'.encode())
+
+    def remove(self, paths: Iterable[str]) -> None:
+        """Remove thumbnails from their pack files, if they exist.
+
+        :param paths: the absolute paths of the thumbnails.
+        """
+        removed = {}  # type: Dict[str, List[str]]
+        for path in paths:
+            if self.get(path) is not None:
+                directory, key = self.locate(path)
+                removed.setdefault(directory, []).append(key)
+        for directory, keys in removed.items():
+            with self.locked(directory) as (index_file, _):
+                index_file.write(''.join(f'{json.dumps([key, -1, 0, 0])}\n'
+                                         for key in keys).encode())
+
+    def compact(self, path: str) -> bool:
+        """Rewrite the pack file of an album if it is mostly garbage.
+
+        :param path: the absolute path of a thumbnail directory, such as
+            ``small/album``.
+        :return: ``True`` if the pack file was rewritten.
+        """
+        location = self.locate(os.path.join(path, '_'))
+        if location is None:
+            return False
+        directory = location[0]
+        pack = self.load(directory)
+        if pack is None:
+            return False
+        with self.lock:
+            if pack.dead <= sum(entry.length for entry in pack.entries.values()):
+                return False
+        with self.locked(directory) as (_, pack_name):
+            pack = self.load(directory)
+            with self.lock:
+                entries = list(pack.entries.items())
+            generation = int(pack_name.split('.')[1]) + 1
+            new_name = f'thumbs.{generation}.pack'
+            lines = [json.dumps(['', new_name])]
+            with open(os.path.join(directory, pack_name), 'rb') as src, \
+                 open(os.path.join(directory, new_name), 'wb') as dst:
+                for key, entry in entries:
+                    src.seek(entry.offset)
+                    offset = dst.tell()
+                    dst.write(src.read(entry.length))
+                    lines.append(json.dumps([key, offset, entry.length,
+                                             entry.mtime]))
+            index_path = os.path.join(directory, self.INDEX)
+            with open(index_path + '.tmp', 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            os.replace(index_path + '.tmp', index_path)
+            os.remove(os.path.join(directory, pack_name))
+        with self.lock:
+            self._unmap(directory)
+        return True
+
+    def _unmap(self, directory: str, keep: str='') -> None:
+        # Forget the maps of the pack files of an album, except keep, so that
+        # the space of removed pack files is reclaimed. Maps which are still
+        # being served are closed by the garbage collector once released.
+        for pack_path in [pack_path for pack_path in self.maps
+                          if os.path.dirname(pack_path) == directory
+                          and pack_path != keep]:
+            data, _ = self.maps.pop(pack_path)
+            try:
+                data.close()
+            except BufferError:
+                pass
+
+    def load(self, directory: str) -> Optional[Pack]:
+        """Load the index of a pack, reusing the parsed index if possible.
+
+        :param directory: the pack directory of an album.
+        :return: the parsed index, or ``None`` if there is no pack.
+        """
+        try:
+            f = open(os.path.join(directory, self.INDEX), 'rb')
+        except OSError:
+            return None
+        with f, self.lock:
+            stat = os.fstat(f.fileno())
+            key = (stat.st_ino, stat.st_dev)
+            pack = self.packs.get(directory)
+            if pack is not None and pack.key == key:
+                if pack.parsed == stat.st_size:
+                    return pack
+                # Only parse the lines appended since the last load
+                f.seek(pack.parsed)
+                name, entries, dead = pack.name, pack.entries, pack.dead
+            else:
+                name, entries, dead = '', {}, 0
+            parsed = f.tell()
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                parsed += len(line)
+                try:
+                    name_or_key, offset, *rest = json.loads(line)
+                except ValueError:
+                    continue
+                if not name_or_key:
+                    name = offset
+                    continue
+                old = entries.pop(name_or_key, None)
+                dead += old.length if old else 0
+                if offset >= 0:
+                    entries[name_or_key] = PackEntry(offset, *rest)
+            pack = Pack(key, parsed, name, entries, dead)
+            self.packs[directory] = pack
+        return pack
+
+    @contextlib.contextmanager
+    def locked(self, directory: str) -> Iterator[Tuple[BinaryIO, str]]:
+        """Lock the index of a pack for writing, creating the pack if needed.
+
+        :param directory: the pack directory of an album.
+        :return: a context manager which yields a tuple of (the index file
+            opened for appending, the name of the current pack file).
+        """
+        index_path = os.path.join(directory, self.INDEX)
+        os.makedirs(directory, exist_ok=True)
+        while True:
+            f = open(index_path, 'ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.stat(index_path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # The index was replaced by compact() while waiting for the lock
+            f.close()
+        with f:
+            if f.tell() == 0:
+                f.write(f'{json.dumps(["", "thumbs.0.pack"])}\n'.encode())
+                f.flush()
+            with open(index_path, 'rb') as header:
+                name = json.loads(header.readline())[1]
+            yield f, name
+
+
+_stores = {}  # type: Dict[str, PackStore]
+
+
+def forget_stores() -> None:
+    """Forget the stores of the parent process in a forked child.
+
+    Stores hold locks and memory maps which must not be shared with a
+    child process. This is called automatically after a fork on Python 3.7
+    and above, and by worker processes when they start.
+    """
+    _stores.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=forget_stores)
+
+
+def pack_store(thumb_dir: str) -> PackStore:
+    """Get the :class:`PackStore` of :attr:`thumb_dir` shared by this process.
+
+    :param thumb_dir: the path to the generated website.
+    :return: the store, which is created on first use.
+    """
+    store = _stores.get(thumb_dir)
+    if store is None:
+        store = _stores.setdefault(thumb_dir, PackStore(thumb_dir))
+    return store
@@ -0,0 +1,708 @@
+import os
+import html
+import json
+import time
+import threading
+import email.utils
+import mimetypes
+import posixpath
+import urllib.parse
+from collections import OrderedDict
+from datetime import timezone
+from http import HTTPStatus
+from http.server import DEFAULT_ERROR_CONTENT_TYPE, DEFAULT_ERROR_MESSAGE
+from typing import (BinaryIO, Callable, Dict, List, Mapping, Optional, Set,
+                    Tuple, Union)
+
+from shis.metrics import Metrics
+from shis.pack import PackStore
+
+
+# Extensions of files which may have precompressed copies
+COMPRESSIBLE = ['.html', '.css', '.js', '.json', '.svg', '.ttf', '.ico']
+# Content codings in order of preference, with the extension of their copies
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+# A part of the content of a response, either bytes or (offset, length)
+Segment = Union[bytes, memoryview, Tuple[int, int]]
+# Requests with more ranges than this receive the entire file instead
+MAX_RANGES = 64
+
+
+class Response:
+    """A response to an HTTP request, independent of the server engine.
+
+    The content of the response is a list of :attr:`segments`, which are
+    sent one after the other. Each segment is either a bytes-like object,
+    or a tuple of (offset, length) referring to a part of :attr:`file`,
+    which engines may send using ``sendfile``. The engine is responsible
+    for closing the response with :meth:`close` once it has been sent.
+
+    :param status: the HTTP status of the response.
+    :param headers: a list of (name, value) tuples.
+    :param body: the content of the response, if it is small.
+    :param file: an open binary file to send segments from.
+    :param segments: the content of the response (default: :attr:`body`).
+    """
+
+    def __init__(self, status: HTTPStatus, headers: List[Tuple[str, str]]=None,
+                 body: bytes=b'', file: Optional[BinaryIO]=None,
+                 segments: List[Segment]=None):
+        self.status = HTTPStatus(status)
+        self.headers = headers or []
+        self.file = file
+        if segments is None:
+            segments = [body] if body else []
+        self.segments = segments
+        self.on_close = None  # type: Optional[Callable[[Response], None]]
+
+    def close(self) -> None:
+        """Close :attr:`file`, if any, and call :attr:`on_close` once."""
+        if self.file is not None:
+            self.file.close()
+        on_close, self.on_close = self.on_close, None
+        if on_close is not None:
+            on_close(self)
+            self.file = None
+
+
+class FileCache:
+    """A cache of the contents of small files, bounded by size in bytes.
+
+    Files are cached along with their inode, ``mtime`` and size, and an
+    entry is only used as long as these match a fresh ``stat`` of the file.
+    When the cache is full, the least recently used files are evicted.
+    Counters of hits, misses and evictions are kept for :meth:`stats`.
+
+    :param max_size: the maximum total size of cached files in bytes.
+    :param max_file_size: the size of the largest file to cache
+        (default: 1/16th of :attr:`max_size`, at most 1 MiB).
+    """
+
+    def __init__(self, max_size: int, max_file_size: int=None):
+        self.max_size = max_size
+        self.max_file_size = max_file_size or min(max_size // 16, 1 << 20)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # type: Dict[str, Tuple[Tuple, bytes]]
+
+    def fits(self, size: int) -> bool:
+        """Check whether a file of :attr:`size` bytes may be cached."""
+        return size <= self.max_file_size
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[bytes]:
+        """Fetch the contents of a file if they are cached and current.
+
+        :param path: the local path of the file.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :return: the contents of the file, or ``None``.
+        """
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry[0] != key:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(path)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, path: str, stat: os.stat_result, data: bytes) -> None:
+        """Add the contents of a file, evicting other files if needed.
+
+        :param path: the local path of the file.
+        :param stat: the result of ``os.stat`` on :attr:`path`.
+        :param data: the contents of the file.
+        """
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = (key, data)
+            self.size += len(data)
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, path: str=None) -> None:
+        """Remove a file from the cache, or all files if :attr:`path` is ``None``.
+
+        :param path: the local path of the file.
+        """
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.size = 0
+            else:
+                self._remove(path)
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        """Return counters describing the effectiveness of the cache."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+            }
+
+    def _remove(self, path: str) -> None:
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+
+class Resolver:
+    """Map HTTP requests to files inside :attr:`directory`.
+
+    The resolver implements the behaviour of ``SimpleHTTPRequestHandler``
+    without doing any I/O on the connection, so that every server engine
+    serves the same URLs in the same way.
+
+    Special URLs which do not correspond to files, such as statistics,
+    are served by the functions in :attr:`endpoints`. Responses passed to
+    :meth:`track` are recorded in :attr:`metrics`, which are served at
+    ``/metrics``. URLs starting with a name in :attr:`aliases` are served
+    from another directory, and thumbnails stored in :attr:`packs` are
+    served straight out of their memory mapped pack files. Directories are
+    never listed under an alias, and files are only served if
+    :attr:`alias_filter` accepts them. Files whose path starts with one of
+    :attr:`hidden` are never served or listed.
+
+    :param directory: the directory to serve files from.
+    :param cache_size: the maximum number of bytes to keep in a
+        :class:`FileCache`, or ``0`` to disable caching.
+    :param packs: the store of packed thumbnails, if any.
+    """
+
+    def __init__(self, directory: str, cache_size: int=0,
+                 packs: Optional[PackStore]=None):
+        self.directory = directory
+        self.packs = packs
+        self.aliases = {}  # type: Dict[str, str]
+        self.alias_filter = None  # type: Optional[Callable[[str], bool]]
+        self.hidden = []  # type: List[str]
+        self.on_view = None  # type: Optional[Callable[[str], None]]
+        self.on_demand = None  # type: Optional[Callable[[str], bool]]
+        self.cache = FileCache(cache_size) if cache_size > 0 else None
+        self.metrics = Metrics()
+        self.endpoints = {}  # type: Dict[str, Callable[[], Response]]
+        self.endpoints['/metrics'] = self.respond_metrics
+        if self.cache is not None:
+            self.endpoints['/_shis/cache'] = lambda: self.json(self.cache.stats())
+            for name, kind, help_text in [
+                    ('hits', 'counter', 'Requests served from memory.'),
+                    ('misses', 'counter', 'Requests served from disk.'),
+                    ('size', 'gauge', 'Bytes of files kept in memory.')]:
+                # Counters are suffixed with _total by Prometheus convention
+                suffix = '_total' if kind == 'counter' else ''
+                self.metrics.register(f'shis_cache_{name}{suffix}', kind,
+                    help_text, lambda name=name: self.cache.stats()[name])
+
+    def is_hidden(self, path: str) -> bool:
+        """Check whether a local path must never be served.
+
+        :param path: the local path from :meth:`translate_path`.
+        :return: ``True`` if :attr:`path` starts with one of :attr:`hidden`.
+        """
+        return any(path.startswith(prefix) for prefix in self.hidden)
+
+    def is_fresh(self, path: str, copy_path: str) -> bool:
+        """Check whether a compressed copy matches the current file.
+
+        :func:`~shis.utils.precompress` gives each copy the ``mtime`` of
+        the file it was made from. A copy with any other ``mtime`` is
+        either out of date, still being written, or was left behind by an
+        interrupted write, so the file itself is served instead.
+
+        :param path: the local path of the file.
+        :param copy_path: the local path of its compressed copy.
+        :return: ``True`` if the copy exists and has the same ``mtime``.
+        """
+        try:
+            return os.stat(copy_path).st_mtime_ns == os.stat(path).st_mtime_ns
+        except OSError:
+            return False
+
+    def aliased(self, target: str) -> bool:
+        """Check whether the target of a request is served from an alias.
+
+        :param target: the path of the request, including the query.
+        :return: ``True`` if the first segment of the path is in :attr:`aliases`.
+        """
+        path = urllib.parse.urlsplit(target).path
+        path = posixpath.normpath(urllib.parse.unquote(path, errors='surrogatepass'))
+        words = list(filter(None, path.split('/')))
+        return bool(words) and words[0] in self.aliases
+
+    def translate_path(self, target: str) -> str:
+        """Translate the target of a request to a local path.
+
+        :param target: the path of the request, including the query.
+        :return: the absolute path inside :attr:`directory`.
+        """
+        path = urllib.parse.urlsplit(target).path
+        trailing_slash = path.endswith('/')
+        path = posixpath.normpath(urllib.parse.unquote(path, errors='surrogatepass'))
+        local = self.directory
+        for idx, word in enumerate(filter(None, path.split('/'))):
+            if os.path.dirname(word) or word in (os.curdir, os.pardir):
+                continue
+            if idx == 0 and word in self.aliases:
+                local = self.aliases[word]
+                continue
+            local = os.path.join(local, word)
+        if trailing_slash:
+            local += '/'
+        return local
+
+    def notify(self, path: str) -> None:
+        """Notify the generator about a request before it is served.
+
+        :attr:`on_view` is called with the local path of every request,
+        and :attr:`on_demand` with the local path of any file which does
+        not exist yet.
+
+        :param path: the local path from :meth:`translate_path`.
+        """
+        if self.on_view is not None:
+            self.on_view(path)
+        if self.on_demand is not None and not self.exists(path):
+            self.on_demand(path)
+
+    def exists(self, path: str) -> bool:
+        """Check whether a local path exists, either as a file or in :attr:`packs`.
+
+        :param path: the local path from :meth:`translate_path`.
+        """
+        return os.path.exists(path) or (
+            self.packs is not None and self.packs.get(path) is not None)
+
+    def respond(self, target: str, path: str,
+                headers: Mapping[str, str]) -> Response:
+        """Build the response to a ``GET`` or ``HEAD`` request.
+
+        :param target: the path of the request, including the query.
+        :param path: the local path from :meth:`translate_path`.
+        :param headers: the headers of the request.
+        :return: the response to send.
+        """
+        endpoint = self.endpoints.get(urllib.parse.urlsplit(target).path)
+        if endpoint is not None:
+            return endpoint()
+        if self.is_hidden(path):
+            return self.error(HTTPStatus.NOT_FOUND)
+        if self.aliased(target) and (path.endswith('/') or os.path.isdir(path)
+            or (self.alias_filter is not None and not self.alias_filter(path))):
+            return self.error(HTTPStatus.NOT_FOUND)
+        if os.path.isdir(path):
+            parts = urllib.parse.urlsplit(target)
+            if not parts.path.endswith('/'):
+                location = urllib.parse.urlunsplit(
+                    ('', '', parts.path + '/', parts.query, parts.fragment))
+                return Response(HTTPStatus.MOVED_PERMANENTLY,
+                    [('Location', location), ('Content-Length', '0')])
+            for index in ('index.html', 'index.htm'):
+                index = os.path.join(path, index)
+                if os.path.isfile(index):
+                    path = index
+                    break
+            else:
+                return self.list_directory(path, parts.path)
+        if path.endswith('/'):
+            return self.error(HTTPStatus.NOT_FOUND)
+        content_type = self.guess_type(path)
+        vary, encoding = [], None
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE:
+            vary = [('Vary', 'Accept-Encoding')]
+            accepted = self.accepted_encodings(headers)
+            for name, ext in ENCODINGS:
+                if name in accepted and self.is_fresh(path, path + ext):
+                    path, encoding = path + ext, name
+                    break
+        try:
+            file, stat, data = self.load(path)
+        except OSError:
+            return self.error(HTTPStatus.NOT_FOUND)
+        response = None
+        try:
+            cache_headers = vary + [
+                ('ETag', self.etag(stat)),
+                ('Last-Modified', email.utils.formatdate(
+                    stat.st_mtime, usegmt=True)),
+                ('Cache-Control', self.cache_control(target)),
+            ]
+            if self.not_modified(headers, stat):
+                response = Response(HTTPStatus.NOT_MODIFIED, cache_headers)
+            else:
+                if encoding is not None:
+                    cache_headers.append(('Content-Encoding', encoding))
+                response = self.respond_file(file, stat, content_type,
+                    headers, cache_headers)
+        finally:
+            if file is not None and (response is None or response.file is None):
+                file.close()
+        if data is not None:
+            # Serve segments of cached files from memory
+            response.segments = [
+                segment if not isinstance(segment, tuple)
+                else data if segment == (0, len(data))
+                else data[segment[0]:segment[0] + segment[1]]
+                for segment in response.segments]
+        return response
+
+    def track(self, response: Response, start: float) -> None:
+        """Record a response in :attr:`metrics` once it has been sent.
+
+        :param response: the response from :meth:`respond`.
+        :param start: the value of ``time.perf_counter()`` when the
+            request was received.
+        """
+        size = sum(segment[1] if isinstance(segment, tuple) else len(segment)
+                   for segment in response.segments)
+        response.on_close = lambda response: self.metrics.observe(
+            response.status.value, time.perf_counter() - start, size)
+
+    def respond_metrics(self) -> Response:
+        """Produce the current :attr:`metrics` in the Prometheus text format.
+
+        :return: the response containing the metrics.
+        """
+        body = self.metrics.render().encode()
+        return Response(HTTPStatus.OK, [
+            ('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ], body=body)
+
+    def load(self, path: str) -> Tuple[Optional[BinaryIO], os.stat_result,
+                                       Optional[Union[bytes, memoryview]]]:
+        """Open a file, or fetch its contents from :attr:`packs` or :attr:`cache`.
+
+        Packed thumbnails are described by a ``stat`` made up from their
+        pack entry, which is all that is needed for the headers.
+
+        :param path: the local path of the file.
+        :return: a tuple of (file, stat, data). Either the open file or
+            its contents are returned, but never both.
+        :raises OSError: if the file could not be opened.
+        """
+        packed = self.packs.read(path) if self.packs is not None else None
+        if packed is not None:
+            data, entry, inode = packed
+            mtime = entry.mtime // 10**9
+            stat = os.stat_result(
+                (0o100644, inode, 0, 1, 0, 0, entry.length, mtime, mtime, mtime),
+                {'st_mtime': entry.mtime / 10**9, 'st_mtime_ns': entry.mtime})
+            return None, stat, data
+        if self.cache is not None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.cache.invalidate(path)
+                raise
+            data = self.cache.get(path, stat)
+            if data is not None:
+                return None, stat, data
+        file = open(path, 'rb')
+        try:
+            stat = os.fstat(file.fileno())
+            if self.cache is not None and self.cache.fits(stat.st_size):
+                data = file.read()
+                file.close()
+                self.cache.put(path, stat, data)
+                return None, stat, data
+        except Exception:
+            file.close()
+            raise
+        return file, stat, None
+
+    def respond_file(self, file: Optional[BinaryIO], stat: os.stat_result,
+                     content_type: str, headers: Mapping[str, str],
+                     response_headers: List[Tuple[str, str]]) -> Response:
+        """Build the response for the contents of a file.
+
+        :param file: the open file, or ``None`` if it is cached.
+        :param stat: the result of ``os.stat`` on the file.
+        :param content_type: the ``Content-Type`` of the file.
+        :param headers: the headers of the request.
+        :param response_headers: additional headers of the response.
+        :return: the response to send.
+        """
+        size, ranges = stat.st_size, None
+        if 'Range' in headers and self.if_range(headers, stat):
+            ranges = self.parse_range(headers['Range'], size)
+        if ranges is None or len(ranges) > MAX_RANGES:
+            return Response(HTTPStatus.OK, [
+                ('Content-Type', content_type),
+                ('Content-Length', str(size)),
+                ('Accept-Ranges', 'bytes'),
+                *response_headers,
+            ], file=file, segments=[(0, size)])
+        if not ranges:
+            response = self.error(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            response.headers.append(('Content-Range', f'bytes */{size}'))
+            return response
+        return self.partial_content(file, size, content_type, ranges,
+            response_headers)
+
+    def partial_content(self, file: BinaryIO, size: int, content_type: str,
+                        ranges: List[Tuple[int, int]],
+                        headers: List[Tuple[str, str]]) -> Response:
+        """Build a ``206 Partial Content`` response for some byte ranges.
+
+        A single range is sent as is, while multiple ranges are sent as a
+        ``multipart/byteranges`` document.
+
+        :param file: the open file to send ranges from.
+        :param size: the size of :attr:`file`.
+        :param content_type: the ``Content-Type`` of :attr:`file`.
+        :param ranges: a list of (first, last) byte positions, inclusive.
+        :param headers: additional headers of the response.
+        :return: the response to send.
+        """
+        headers = [('Accept-Ranges', 'bytes'), *headers]
+        if len(ranges) == 1:
+            first, last = ranges[0]
+            return Response(HTTPStatus.PARTIAL_CONTENT, [
+                ('Content-Type', content_type),
+                ('Content-Length', str(last - first + 1)),
+                ('Content-Range', f'bytes {first}-{last}/{size}'),
+                *headers,
+            ], file=file, segments=[(first, last - first + 1)])
+        boundary = os.urandom(12).hex()
+        segments = []
+        for first, last in ranges:
+            segments.append((f'\r\n--{boundary}\r\n'
+                             f'Content-Type: {content_type}\r\n'
+                             f'Content-Range: bytes {first}-{last}/{size}\r\n'
+                             f'\r\n').encode('latin-1'))
+            segments.append((first, last - first + 1))
+        segments.append(f'\r\n--{boundary}--\r\n'.encode('latin-1'))
+        length = sum(segment[1] if isinstance(segment, tuple)
+                     else len(segment) for segment in segments)
+        return Response(HTTPStatus.PARTIAL_CONTENT, [
+            ('Content-Type', f'multipart/byteranges; boundary={boundary}'),
+            ('Content-Length', str(length)),
+            *headers,
+        ], file=file, segments=segments)
+
+    @staticmethod
+    def parse_range(header: str, size: int) -> Optional[List[Tuple[int, int]]]:
+        """Parse the ``Range`` header of a request.
+
+        Overlapping and adjacent ranges are merged, so that no part of the
+        file is sent more than once (RFC 7233, section 6.1).
+
+        :param header: the value of the header.
+        :param size: the size of the requested file.
+        :return: a sorted list of satisfiable (first, last) byte positions,
+            which is empty if no range can be satisfied, or ``None`` if the
+            header is invalid and should be ignored.
+        """
+        unit, _, spec = header.partition('=')
+        if unit.strip().lower() != 'bytes':
+            return None
+        ranges, parts = [], [part for part in spec.split(',') if part.strip()]
+        for part in parts:
+            first, sep, last = (value.strip() for value in part.partition('-'))
+            if (not sep or not (first or last) or (first and not first.isdigit())
+                or (last and not last.isdigit())):
+                return None
+            if not first:
+                # The last N bytes
+                if int(last) > 0 and size > 0:
+                    ranges.append((max(0, size - int(last)), size - 1))
+            elif last and int(last) < int(first):
+                return None
+            elif int(first) < size:
+                last = min(int(last), size - 1) if last else size - 1
+                ranges.append((int(first), last))
+        if not parts:
+            return None
+        merged = []  # type: List[Tuple[int, int]]
+        for first, last in sorted(ranges):
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
+    def if_range(self, headers: Mapping[str, str], stat: os.stat_result) -> bool:
+        """Check whether the ``Range`` header of a request should be used.
+
+        :param headers: the headers of the request.
+        :param stat: the result of ``os.stat`` on the file.
+        :return: ``False`` if ``If-Range`` does not match the current
+            version of the file, ``True`` otherwise.
+        """
+        if 'If-Range' not in headers:
+            return True
+        value = headers['If-Range'].strip()
+        if value.startswith('"') or value.startswith('W/'):
+            return value == self.etag(stat)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=timezone.utc)
+        return date.timestamp() == int(stat.st_mtime)
+
+    @staticmethod
+    def accepted_encodings(headers: Mapping[str, str]) -> Set[str]:
+        """Parse the ``Accept-Encoding`` header of a request.
+
+        :param headers: the headers of the request.
+        :return: the names of content codings the client accepts.
+        """
+        accepted = set()
+        for coding in headers.get('Accept-Encoding', '').split(','):
+            name, _, params = coding.partition(';')
+            name, params = name.strip().lower(), params.replace(' ', '')
+            if params.startswith('q='):
+                try:
+                    if float(params[2:]) <= 0:
+                        continue
+                except ValueError:
+                    continue
+            if name == '*':
+                accepted.update(name for name, _ in ENCODINGS)
+            elif name:
+                accepted.add(name)
+        return accepted
+
+    @staticmethod
+    def etag(stat: os.stat_result) -> str:
+        """Compute a strong ``ETag`` from the inode, ``mtime`` and size of a file.
+
+        Generated files are replaced atomically, so a file with new
+        contents also has a new inode and ``mtime``.
+
+        :param stat: the result of ``os.stat`` on the file.
+        :return: a quoted entity tag.
+        """
+        return f'"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+
+    @staticmethod
+    def cache_control(target: str) -> str:
+        """Choose the ``Cache-Control`` header for a file.
+
+        URLs which carry a ``v`` query parameter are versioned by their
+        content: whenever the file changes, pages link to it with a new
+        version. These are cached forever. Everything else, including all
+        HTML pages, has to be revalidated using its ``ETag`` before use.
+
+        :param target: the path of the request, including the query.
+        :return: the value of the header.
+        """
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(target).query)
+        if query.get('v', [''])[0]:
+            return 'public, max-age=31536000, immutable'
+        return 'no-cache'
+
+    def not_modified(self, headers: Mapping[str, str],
+                     stat: os.stat_result) -> bool:
+        """Check whether the client already has the current version of a file.
+
+        ``If-None-Match`` is compared with the :meth:`etag` of the file.
+        ``If-Modified-Since`` is only used if there is no ``If-None-Match``.
+
+        :param headers: the headers of the request.
+        :param stat: the result of ``os.stat`` on the file.
+        :return: ``True`` if the client already has the current version.
+        """
+        if 'If-None-Match' in headers:
+            etag = self.etag(stat)
+            for tag in headers['If-None-Match'].split(','):
+                tag = tag.strip()
+                if tag.startswith('W/'):
+                    tag = tag[2:]
+                if tag in ('*', etag):
+                    return True
+            return False
+        if 'If-Modified-Since' not in headers:
+            return False
+        try:
+            ims = email.utils.parsedate_to_datetime(headers['If-Modified-Since'])
+        except (TypeError, IndexError, OverflowError, ValueError):
+            return False
+        if ims.tzinfo is None:
+            ims = ims.replace(tzinfo=timezone.utc)
+        return int(stat.st_mtime) <= ims.timestamp()
+
+    def list_directory(self, path: str, url_path: str) -> Response:
+        """Produce a listing of a directory without an ``index.html``.
+
+        :param path: the local path of the directory.
+        :param url_path: the path of the request, without the query.
+        :return: the response containing the listing.
+        """
+        try:
+            names = sorted(os.listdir(path), key=lambda name: name.lower())
+        except OSError:
+            return self.error(HTTPStatus.NOT_FOUND)
+        title = html.escape(urllib.parse.unquote(url_path), quote=False)
+        lines = ['<!DOCTYPE HTML>', '<html>', '<head>',
+                 '<meta charset="utf-8">', f'<title>Directory listing for {title}</title>',
+                 '</head>', '<body>', f'<h1>Directory listing for {title}</h1>',
+                 '<hr>', '<ul>']
+        for name in names:
+            display = link = name
+            fullname = os.path.join(path, name)
+            if self.is_hidden(fullname):
+                continue
+            if os.path.isdir(fullname):
+                display = link = name + '/'
+            if os.path.islink(fullname):
+                display = name + '@'
+            lines.append('<li><a href="{}">{}</a></li>'.format(
+                urllib.parse.quote(link, errors='surrogatepass'),
+                html.escape(display, quote=False)))
+        lines.extend(['</ul>', '<hr>', '</body>', '</html>', ''])
+        body = '\n'.join(lines).encode('utf-8', 'surrogateescape')
+        return Response(HTTPStatus.OK, [
+            ('Content-Type', 'text/html; charset=utf-8'),
+            ('Content-Length', str(len(body))),
+        ], body=body)
+
+    @staticmethod
+    def json(data: Dict) -> Response:
+        """Produce a JSON response which must not be cached.
+
+        :param data: the object to encode.
+        :return: the response containing the encoded object.
+        """
+        body = json.dumps(data, indent=2).encode()
+        return Response(HTTPStatus.OK, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+            ('Cache-Control', 'no-store'),
+        ], body=body)
+
+    def error(self, status: HTTPStatus) -> Response:
+        """Produce an HTML error page.
+
+        :param status: the HTTP status of the error.
+        :return: the response containing the error page.
+        """
+        status = HTTPStatus(status)
+        body = (DEFAULT_ERROR_MESSAGE % {
+            'code': status.value,
+            'message': html.escape(status.phrase, quote=False),
+            'explain': html.escape(status.description, quote=False),
+        }).encode('utf-8', 'replace')
+        return Response(status, [
+            ('Content-Type', DEFAULT_ERROR_CONTENT_TYPE),
+            ('Content-Length', str(len(body))),
+        ], body=body)
+
+    @staticmethod
+    def guess_type(path: str) -> str:
+        """Guess the ``Content-Type`` of a file from its extension."""
+        return mimetypes.guess_type(path)[0] or 'application/octet-stream'
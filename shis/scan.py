@@ -0,0 +1,249 @@
+import os
+import queue
+import argparse
+from typing import Dict, Iterable, Iterator, List, NamedTuple
+
+from shis.utils import filter_image
+
+
+class Folder(NamedTuple):
+    """A single directory of the :class:`Tree`.
+
+    :param path: the absolute path of the directory.
+    :param folders: names of subdirectories, in listing order.
+    :param files: image files in the directory, in listing order, mapped
+        to their ``os.DirEntry``. Each entry has already been ``stat``-ed,
+        so ``entry.stat()`` never results in another system call.
+    :param size: the total number of entries in the directory.
+    """
+    path: str
+    folders: List[str]
+    files: Dict[str, os.DirEntry]
+    size: int
+
+
+class Tree:
+    """An in-memory model of :attr:`args.image_dir`.
+
+    The tree is built once per cycle by :func:`scan_tree` using a single
+    ``os.scandir`` per directory, and is then shared by
+    :func:`~shis.server.process_paths` and :func:`~shis.server.generate_albums`.
+    Folders are stored in the same top-down order as ``os.walk``.
+
+    :param args: preprocessed command line arguments.
+    """
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.folders = {}  # type: Dict[str, Folder]
+        self._covers = {}  # type: Dict[str, str]
+
+    def __iter__(self) -> Iterator[Folder]:
+        return iter(list(self.folders.values()))
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.folders
+
+    def __getitem__(self, path: str) -> Folder:
+        return self.folders[path]
+
+    def __len__(self) -> int:
+        return len(self.folders)
+
+    def has_image(self, path: str) -> bool:
+        """Check whether an image is part of the tree.
+
+        :param path: the absolute path of the image.
+        :return: ``True`` if :attr:`path` was found while scanning.
+        """
+        root, name = os.path.split(path)
+        folder = self.folders.get(root)
+        return folder is not None and name in folder.files
+
+    def stat(self, path: str) -> os.stat_result:
+        """Return the cached ``stat`` of an image in the tree.
+
+        :param path: the absolute path of the image.
+        :return: the ``stat`` result obtained while scanning.
+        """
+        root, name = os.path.split(path)
+        return self.folders[root].files[name].stat()
+
+    def cover(self, path: str) -> str:
+        """Find the first available image in a folder or its subfolders.
+
+        :param path: the absolute path of the folder.
+        :return: the absolute path of the first image in :attr:`path` if
+            it exists, empty string otherwise.
+        """
+        if path in self._covers:
+            return self._covers[path]
+        image = ''
+        folder = self.folders.get(path)
+        if folder is not None:
+            if folder.files:
+                image = os.path.join(path, next(iter(folder.files)))
+            else:
+                for name in folder.folders:
+                    image = self.cover(os.path.join(path, name))
+                    if image:
+                        break
+        self._covers[path] = image
+        return image
+
+    def scan(self, path: str) -> Folder:
+        """List a single directory and add it to the tree.
+
+        :param path: the absolute path of the directory to scan.
+        :return: the scanned folder.
+        :raises OSError: if the directory could not be listed.
+        """
+        folder = self.read(path)
+        self.folders[path] = folder
+        return folder
+
+    def read(self, path: str) -> Folder:
+        """List a single directory without adding it to the tree.
+
+        This does not modify the tree, so it is safe to call from several
+        threads at once.
+
+        :param path: the absolute path of the directory to list.
+        :return: the listed folder.
+        :raises OSError: if the directory could not be listed.
+        """
+        if path.count('/') > 100:
+            raise ValueError(f'Too many subdirectories: {path}')
+        folders, files, size = [], {}, 0
+        with os.scandir(path) as entries:
+            for entry in entries:
+                size += 1
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if is_dir:
+                    if (not entry.is_symlink()
+                        and self.args.thumb_dir not in entry.path):
+                        folders.append(entry.name)
+                elif filter_image(entry.name):
+                    try:
+                        entry.stat()
+                    except OSError:
+                        continue
+                    files[entry.name] = entry
+        return Folder(path, folders, files, size)
+
+    def update(self, paths: Iterable[str]) -> List[Folder]:
+        """Scan some directories again and update the tree in place.
+
+        New subdirectories are scanned recursively, and directories which
+        no longer exist are removed from the tree along with their
+        subdirectories.
+
+        :param paths: the absolute paths of directories which have changed.
+        :return: the folders which were scanned again, in tree order.
+        """
+        self._covers.clear()
+        updated = set()
+        pending = sorted(path for path in paths if path in self.folders
+            or os.path.dirname(path) in self.folders)
+        while pending:
+            path = pending.pop()
+            old = self.folders.get(path)
+            try:
+                folder = self.scan(path)
+            except (OSError, ValueError):
+                self.remove(path)
+                continue
+            updated.add(path)
+            old_folders = set(old.folders) if old else set()
+            for name in folder.folders:
+                child = os.path.join(path, name)
+                if child not in self.folders or name not in old_folders:
+                    pending.append(child)
+            for name in old_folders - set(folder.folders):
+                self.remove(os.path.join(path, name))
+        return [folder for path, folder in self.folders.items()
+                if path in updated]
+
+    def remove(self, path: str) -> None:
+        """Remove a directory and all its subdirectories from the tree.
+
+        :param path: the absolute path of the directory.
+        """
+        prefix = path + os.path.sep
+        for key in [key for key in self.folders
+                    if key == path or key.startswith(prefix)]:
+            del self.folders[key]
+
+
+def scan_tree(args: argparse.Namespace) -> Tree:
+    """Scan :attr:`args.image_dir` and build a :class:`Tree`.
+
+    Directories inside :attr:`args.thumb_dir` are never visited, and
+    directories which cannot be listed are skipped, just like ``os.walk``.
+    If :attr:`args.scan_threads` is more than one, directories are listed
+    by :func:`scan_parallel` instead.
+
+    :param args: preprocessed command line arguments.
+    :return: a tree describing all folders and images.
+    """
+    if args.scan_threads > 1:
+        return scan_parallel(args)
+    tree = Tree(args)
+    pending = [args.image_dir]
+    while pending:
+        path = pending.pop()
+        try:
+            folder = tree.scan(path)
+        except OSError:
+            continue
+        pending.extend(os.path.join(path, name)
+                       for name in reversed(folder.folders))
+    return tree
+
+
+def scan_parallel(args: argparse.Namespace) -> Tree:
+    """Scan :attr:`args.image_dir` using :attr:`args.scan_threads` threads.
+
+    On network filesystems such as NFS or SMB, every ``scandir`` and
+    ``stat`` is a round trip to the server, so listing one directory at a
+    time spends most of its time waiting. Here, every subdirectory is
+    listed by a pool of threads as soon as its parent has been listed.
+    Once everything has been listed, folders are added to the tree in the
+    same order as :func:`scan_tree`, so the result does not depend on the
+    order in which listings complete.
+
+    :param args: preprocessed command line arguments.
+    :return: a tree describing all folders and images.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    tree = Tree(args)
+    listed = {}  # type: Dict[str, Folder]
+    finished = queue.Queue()
+    with ThreadPoolExecutor(max_workers=args.scan_threads) as pool:
+        pending, paths = {}, [args.image_dir]
+        while paths or pending:
+            for path in paths:
+                future = pool.submit(tree.read, path)
+                pending[future] = path
+                future.add_done_callback(finished.put)
+            future = finished.get()
+            path = pending.pop(future)
+            try:
+                folder = future.result()
+            except OSError:
+                paths = []
+                continue
+            listed[path] = folder
+            paths = [os.path.join(path, name) for name in folder.folders]
+    pending = [args.image_dir]
+    while pending:
+        folder = listed.get(pending.pop())
+        if folder is None:
+            continue
+        tree.folders[folder.path] = folder
+        pending.extend(os.path.join(folder.path, name)
+                       for name in reversed(folder.folders))
+    return tree
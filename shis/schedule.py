@@ -0,0 +1,116 @@
+import os
+import time
+import argparse
+import threading
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Tuple
+
+Key = Tuple[str, int]
+
+
+class Scheduler:
+    """A priority queue of images waiting to be thumbnailed.
+
+    Images are grouped by album and page. By default, pages are processed
+    in the order in which they were added. Whenever the server serves a
+    page, :meth:`view` boosts it so that its images are processed next,
+    followed by the remaining pages of the same album. The most recently
+    viewed page always comes first, so the queue reorders itself while
+    thumbnails are being generated.
+
+    :param args: preprocessed command line arguments.
+    :param max_boosts: the number of recently viewed pages to remember.
+    """
+
+    def __init__(self, args: argparse.Namespace, max_boosts: int=32):
+        self.args = args
+        self.max_boosts = max_boosts
+        self.lock = threading.Lock()
+        self.queues = OrderedDict()  # type: Dict[str, Dict[int, Deque]]
+        self.boosts = OrderedDict()  # type: Dict[Key, float]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return sum(len(queue) for pages in self.queues.values()
+                       for queue in pages.values())
+
+    def push(self, item, album: str, page: int) -> None:
+        """Add an item to the queue.
+
+        :param item: the item to add, usually a tuple of paths.
+        :param album: the absolute path of the directory of the image.
+        :param page: the index of the page the image appears on.
+        """
+        with self.lock:
+            pages = self.queues.setdefault(album, OrderedDict())
+            pages.setdefault(page, deque()).append(item)
+
+    def pop(self):
+        """Remove and return the item with the highest priority.
+
+        :return: the next item, or ``None`` if the queue is empty.
+        """
+        with self.lock:
+            # Recently viewed pages, then other pages of the same album
+            for album, page in reversed(self.boosts):
+                pages = self.queues.get(album)
+                if pages:
+                    return self._pop(album, page if page in pages
+                                     else next(iter(pages)))
+            # Everything else in order
+            for album, pages in self.queues.items():
+                return self._pop(album, next(iter(pages)))
+            return None
+
+    def pop_many(self, count: int) -> List:
+        """Remove and return up to :attr:`count` items in order of priority.
+
+        :param count: the maximum number of items to return.
+        :return: a list of items, which is empty if the queue is empty.
+        """
+        items = []
+        while len(items) < count:
+            item = self.pop()
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def boost(self, album: str, page: int) -> None:
+        """Give the highest priority to a page.
+
+        :param album: the absolute path of the directory of the album.
+        :param page: the index of the page.
+        """
+        with self.lock:
+            self.boosts.pop((album, page), None)
+            self.boosts[(album, page)] = time.monotonic()
+            while len(self.boosts) > self.max_boosts:
+                self.boosts.popitem(last=False)
+
+    def view(self, path: str) -> None:
+        """Boost the page served from a local path, if it is a page.
+
+        :param path: the local path of a file or directory being served.
+        """
+        html_dir = os.path.join(self.args.thumb_dir, 'html')
+        if os.path.basename(path) == 'index.html':
+            path = os.path.dirname(path)
+        if path != html_dir and not path.startswith(html_dir + os.path.sep):
+            return
+        parts = os.path.relpath(path, html_dir).split(os.path.sep)
+        page = 0
+        if len(parts) >= 2 and parts[-2] == 'page' and parts[-1].isdigit():
+            page = int(parts[-1]) - 1
+            parts = parts[:-2]
+        album = os.path.normpath(os.path.join(self.args.image_dir, *parts))
+        self.boost(album, page)
+
+    def _pop(self, album: str, page: int):
+        pages = self.queues[album]
+        item = pages[page].popleft()
+        if not pages[page]:
+            del pages[page]
+            if not pages:
+                del self.queues[album]
+        return item
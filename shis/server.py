@@ -1,78 +1,542 @@
 import argparse
+import base64
+import hashlib
+import io
+import json
 import math
 import os
 import sys
 import shutil
+import signal
 import random
+import threading
 import time
-from itertools import repeat
-from multiprocessing import cpu_count
-from typing import Dict, Tuple
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
 
-import imagesize
-from tqdm import tqdm
 from PIL import Image, ImageOps
-from tqdm.contrib.concurrent import process_map
-from jinja2 import Environment, FileSystemLoader, select_autoescape
 
-from shis.utils import (chunks, filter_image, find_thumb, rreplace, urlify,
-                        start_server, scale_dims, fixed_width_formatter)
+from shis import utils
+from shis.dedup import find_duplicates
+from shis.index import ImageIndex
+from shis import pack
+from shis.pack import pack_store
+from shis.scan import Folder, Tree, scan_tree
+from shis.schedule import Scheduler
+from shis.stats import Stats
+from shis.watch import Watcher
+from shis.utils import (atomic_link, atomic_write, chunks, filter_image, rreplace, slugify,
+                        source_name, sync_dir, hash_dir, precompress, thumb_name, urlify,
+                        start_server, scale_dims, fixed_width_formatter, ENCODERS,
+                        THUMB_FORMATS)
 
+# Modules which are slow to import are imported by the stages using them,
+# so that the server starts without waiting for them.
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+    from jinja2 import Template
 
-def generate_thumbnail(paths: Tuple[str, str, str, str], args: argparse.Namespace):
+
+# Resampling filter and reducing gap for each value of args.preset
+PRESETS = {
+    'fast': (Image.BILINEAR, 1.0),
+    'balanced': (Image.BICUBIC, 2.0),
+    'quality': (Image.LANCZOS, 3.0),
+}
+# Maximum width and height of a sprite sheet in pixels
+SPRITE_SIZE = 4096
+# Maximum width and height of a placeholder in pixels
+PLACEHOLDER_SIZE = 8
+# Jinja2 templates of the website, along with static files
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+# Keys of the data passed to templates which differ between pages of an album
+PAGE_KEYS = ['thumbs', 'sprites', 'start_idx', 'url', 'revpath']
+# Maximum number of pages rendered by a worker in a single task
+RENDER_BATCH = 16
+# Whether process pools can initialize workers, new in Python 3.7
+POOL_INITIALIZER = sys.version_info >= (3, 7)
+# Command line arguments which affect the rendered pages and sprite sheets
+PAGE_OPTIONS = ['image_dir', 'thumb_dir', 'selection', 'pagination', 'grid',
+                'group', 'order', 'sprites', 'pack', 'previews', 'thumb_size',
+                'preview_size', 'sizes', 'thumb_format', 'quality', 'preset']
+
+
+def size_path(args: argparse.Namespace, small_path: str, size: int) -> str:
+    """Get the path of an additional thumbnail size listed in :attr:`args.sizes`.
+
+    :param args: preprocessed command line arguments.
+    :param small_path: the path of the small thumbnail.
+    :param size: the size of the additional thumbnail.
+    :return: the path of the thumbnail of size :attr:`size`.
+    """
+    small_base = os.path.join(args.thumb_dir, 'small')
+    rel_path = os.path.relpath(small_path, small_base)
+    return os.path.join(args.thumb_dir, 'sizes', str(size), rel_path)
+
+
+def thumb_paths(args: argparse.Namespace, image_path: str
+    ) -> Tuple[str, str, str, str]:
+    """Get the paths of the thumbnails of an image, as in :func:`process_paths`.
+
+    :param args: preprocessed command line arguments.
+    :param image_path: the absolute path of the original image.
+    :return: a 4-tuple containing :attr:`image_path`, and the absolute
+        paths of its small, large and full size thumbnails.
+    """
+    image_root, name = os.path.split(image_path)
+    thumb = thumb_name(name, args.thumb_format)
+    return (image_path,
+        os.path.join(rreplace(image_root, args.image_dir, f'{args.thumb_dir}/small'), thumb),
+        os.path.join(rreplace(image_root, args.image_dir, f'{args.thumb_dir}/large'), thumb),
+        os.path.join(rreplace(image_root, args.image_dir, f'{args.thumb_dir}/full'), name))
+
+
+def thumb_mtime(args: argparse.Namespace, path: str) -> Optional[int]:
+    """Get the ``mtime`` of a thumbnail, wherever it is stored.
+
+    :param args: preprocessed command line arguments.
+    :param path: the absolute path of the thumbnail.
+    :return: the ``mtime`` in nanoseconds, or ``None`` if the thumbnail
+        does not exist.
+    """
+    if args.pack:
+        store = pack_store(args.thumb_dir)
+        if store.locate(path) is not None:
+            entry = store.get(path)
+            return entry.mtime if entry is not None else None
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def open_thumb(args: argparse.Namespace, path: str) -> Image.Image:
+    """Open a thumbnail, wherever it is stored.
+
+    :param args: preprocessed command line arguments.
+    :param path: the absolute path of the thumbnail.
+    :return: the opened image.
+    :raises OSError: if the thumbnail does not exist or cannot be read.
+    """
+    packed = pack_store(args.thumb_dir).read(path) if args.pack else None
+    return Image.open(io.BytesIO(packed[0]) if packed else path)
+
+
+def placeholder(im: Image.Image) -> str:
+    """Create a placeholder to display while a thumbnail is loading.
+
+    The placeholder is a copy of the image scaled down to a few pixels,
+    encoded as a ``data:`` URI so that it can be inlined in pages. When
+    browsers stretch it to the size of the thumbnail, it becomes a blurry
+    preview of the image.
+
+    :param im: the image, usually the small thumbnail.
+    :return: a ``data:`` URI of a tiny PNG image.
+    """
+    im = im.copy()
+    im.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE), Image.BILINEAR)
+    if im.mode not in ['RGB', 'RGBA']:
+        alpha = 'A' in im.getbands() or 'transparency' in im.info
+        im = im.convert('RGBA' if alpha else 'RGB')
+    with io.BytesIO() as f:
+        im.save(f, 'PNG', optimize=True)
+        data = base64.b64encode(f.getvalue()).decode()
+    return f'data:image/png;base64,{data}'
+
+
+def save_image(im: Image.Image, path: str, args: argparse.Namespace,
+               timings: Dict=None) -> None:
+    """Save an image, preserving EXIF data if present.
+
+    The format is determined by the extension of :attr:`path`, which is
+    set by :func:`~shis.utils.thumb_name`. JPEG images are saved as
+    optimized progressive JPEGs, and :attr:`args.quality` is passed on to
+    all lossy formats. Images are converted to a compatible mode if needed.
+    The image is encoded in memory, then the file is replaced atomically,
+    so that thumbnails being generated concurrently by
+    :class:`OnDemandGenerator` are never served half written. If
+    :attr:`args.pack` is set, thumbnails are appended to the pack file of
+    their album instead.
+
+    :param im: the image to save.
+    :param path: the path to save the image to.
+    :param args: preprocessed command line arguments.
+    :param timings: if given, the time taken to encode and save the image
+        and the number of bytes written are added to it.
+    """
+    options = {}
+    if 'exif' in im.info:
+        options['exif'] = im.info['exif']
+    _, ext = os.path.splitext(path)
+    ext = ext.lower()
+    if ext in ['.jpg', '.jpeg']:
+        if im.mode not in ['RGB', 'L']:
+            im = im.convert('RGB')
+        options.update(optimize=True, progressive=True)
+    if ext in ['.webp', '.avif'] and im.mode not in ['RGB', 'RGBA']:
+        alpha = 'A' in im.getbands() or 'transparency' in im.info
+        im = im.convert('RGBA' if alpha else 'RGB')
+    if args.quality is not None and ext in ['.jpg', '.jpeg', '.webp', '.avif']:
+        options['quality'] = args.quality
+    image_format = Image.registered_extensions()[ext]
+    start = time.perf_counter()
+    with io.BytesIO() as f:
+        im.save(f, image_format, **options)
+        data = f.getvalue()
+    encoded = time.perf_counter()
+    if args.pack and pack_store(args.thumb_dir).locate(path) is not None:
+        pack_store(args.thumb_dir).write(path, data)
+    else:
+        atomic_write(path, data)
+    if timings is not None:
+        timings['encode'] = timings.get('encode', 0.0) + encoded - start
+        timings['save'] = timings.get('save', 0.0) + time.perf_counter() - encoded
+        timings['bytes_written'] = timings.get('bytes_written', 0) + len(data)
+
+
+def generate_thumbnail(paths: Tuple[str, str, str, str], args: argparse.Namespace,
+                       timings: Dict=None):
     """Takes paths from :func:`process_paths` and generates thumbnail(s).
 
     By default, only one thumbnail of size :attr:`args.thumb_size` is 
     created, while previews are symlinked to the original image.
     If :attr:`args.previews` is set, previews of :attr:`args.preview_size` 
-    will also be created. Download links are always symlinked to the 
-    original image.
+    will also be created. Any additional sizes in :attr:`args.sizes` are
+    created as well. Download links are always symlinked to the 
+    original image, unless :attr:`args.pack` is set.
+
+    The image is decoded only once. All outputs are then created by
+    successively downscaling the same image, from the largest size to the
+    smallest, ending with a :func:`placeholder`. Outputs which are already
+    up to date are not saved again. If all of them are up to date, for
+    instance because they were generated on demand, only the placeholder
+    is created from the small thumbnail.
+
+    Images are never decoded at full resolution if it can be helped.
+    JPEG images are decoded directly at a reduced scale using draft mode,
+    and other images are first reduced by an integer factor before being
+    resampled. How close to the target size this goes is controlled by
+    :attr:`args.preset`.
 
     :param paths: A tuple of paths to process.
     :param args: preprocessed command line arguments.
+    :param timings: if given, the time taken by each of the
+        :attr:`~shis.stats.Stats.STEPS` and the number of bytes read and
+        written are stored in it, see :meth:`~shis.stats.Stats.add_image`.
+    :return: the placeholder of the image, or the exception raised while
+        processing it.
     """
 
     in_file, small_file, large_file, full_file = paths
-    if os.path.exists(small_file):
-        if os.path.getmtime(small_file) >= os.path.getmtime(in_file):
-            return
+    timings = {} if timings is None else timings
     try:
-        # Save Preview
-        im = Image.open(in_file)
+        # Largest first, since images can only be downscaled
+        outputs = [(size, size_path(args, small_file, size))
+                   for size in args.sizes]
+        outputs.append((args.thumb_size, small_file))
         if args.previews:
-            max_size = scale_dims(im.width, im.height, args.preview_size)
-            im.thumbnail(max_size)
-            im = ImageOps.exif_transpose(im)
-            if 'exif' in im.info:
-                exif = im.info['exif']
-                im.save(large_file, exif=exif)
-            else:
-                im.save(large_file)
-        # Save Thumbnail
-        max_size = scale_dims(im.width, im.height, args.thumb_size)
-        im.thumbnail(max_size)
-        im = ImageOps.exif_transpose(im)
-        if 'exif' in im.info:
-            exif = im.info['exif']
-            im.save(small_file, exif=exif)
-        else:
-            im.save(small_file)
-        # Save Full
-        full_dest = os.path.relpath(in_file, os.path.dirname(full_file))
-        os.symlink(full_dest, full_file)
-        return
+            outputs.append((args.preview_size, large_file))
+        outputs.sort(reverse=True)
+        in_mtime = os.stat(in_file).st_mtime_ns
+        fresh = {out_file for _, out_file in outputs
+                 if (thumb_mtime(args, out_file) or -1) >= in_mtime}
+        if len(fresh) == len(outputs):
+            start = time.perf_counter()
+            with open_thumb(args, small_file) as im:
+                result = placeholder(im)
+            timings['placeholder'] = time.perf_counter() - start
+            return result
+        resample, reducing_gap = PRESETS[args.preset]
+        start = time.perf_counter()
+        timings['bytes_read'] = os.stat(in_file).st_size
+        im = Image.open(in_file)
+        # Ask the JPEG decoder to downscale using DCT scaling
+        width, height = scale_dims(im.width, im.height, outputs[0][0])
+        im.draft(None, (round(width * reducing_gap),
+                        round(height * reducing_gap)))
+        im.load()
+        timings['decode'] = time.perf_counter() - start
+        timings['resize'] = 0.0
+        for idx, (size, out_file) in enumerate(outputs):
+            start = time.perf_counter()
+            max_size = scale_dims(im.width, im.height, size)
+            im.thumbnail(max_size, resample, reducing_gap)
+            if idx == 0:
+                im = ImageOps.exif_transpose(im)
+            timings['resize'] += time.perf_counter() - start
+            if out_file not in fresh:
+                save_image(im, out_file, args, timings)
+        # Save Full, packs are served along with the original images
+        if not args.pack and not os.path.lexists(full_file):
+            full_dest = os.path.relpath(in_file, os.path.dirname(full_file))
+            os.symlink(full_dest, full_file)
+        start = time.perf_counter()
+        result = placeholder(im)
+        timings['placeholder'] = time.perf_counter() - start
+        return result
     except Exception as e:
         return e
 
 
-def process_paths(args: argparse.Namespace) -> Tuple[Tuple[str, str, str, str], int, bool]:
+def sprite_dir(thumb_dir: str, url: str) -> str:
+    """Get the directory containing the sprite sheets of a page.
+
+    :param thumb_dir: the path to the generated website.
+    :param url: the URL of the page, relative to :attr:`thumb_dir`.
+    :return: the absolute path of the directory.
+    """
+    return os.path.normpath(os.path.join(thumb_dir, 'sprites',
+        os.path.relpath(url, 'html')))
+
+
+def sprite_layout(tiles: List[Tuple[int, int]], max_size: int=SPRITE_SIZE
+    ) -> Tuple[List[Tuple[int, int, int]], List[Tuple[int, int]]]:
+    """Arrange tiles on as few sprite sheets as needed.
+
+    Tiles are placed left to right in rows, in the order they appear on
+    the page. A new row is started once a row is :attr:`max_size` pixels
+    wide, and a new sheet once a sheet is :attr:`max_size` pixels tall.
+
+    :param tiles: the (width, height) of each tile.
+    :param max_size: the maximum width and height of a sheet.
+    :return: a tuple of (positions, sheets).
+
+        - **positions** (*list*) - the (sheet, x, y) of each tile.
+        - **sheets** (*list*) - the (width, height) of each sheet.
+    """
+    positions, sheets = [], []
+    x = y = row_height = 0
+    for width, height in tiles:
+        if x and x + width > max_size:
+            x, y, row_height = 0, y + row_height, 0
+        if not sheets or (y and y + height > max_size):
+            sheets.append((0, 0))
+            x = y = row_height = 0
+        row_height = max(row_height, height)
+        sheet_width, sheet_height = sheets[-1]
+        sheets[-1] = (max(sheet_width, x + width),
+                      max(sheet_height, y + row_height))
+        positions.append((len(sheets) - 1, x, y))
+        x += width
+    return positions, sheets
+
+
+def sprite_manifest(args: argparse.Namespace, url: str,
+    thumbs: List[Dict]) -> Dict:
+    """Lay out the thumbnails of a page on sprite sheets.
+
+    Each thumbnail is given a ``sprite`` entry with the URL of its sheet
+    and its position on it, for the template to render it as a tile.
+
+    :param args: preprocessed command line arguments.
+    :param url: the URL of the page, relative to :attr:`args.thumb_dir`.
+    :param thumbs: the thumbnails on the page, see :func:`generate_albums`.
+    :return: the manifest of the sprite sheets, containing the size and
+        file name of each sheet, and the position of each tile.
+    """
+    positions, sheets = sprite_layout(
+        [(thumb['width'], thumb['height']) for thumb in thumbs])
+    ext = THUMB_FORMATS.get(args.thumb_format, ['.jpg'])[0]
+    manifest = {
+        'sheets': [{'file': f'{idx}{ext}', 'width': width, 'height': height}
+                   for idx, (width, height) in enumerate(sheets)],
+        'tiles': [{'name': thumb['name'], 'thumb': thumb['small'],
+                   'version': thumb['version'], 'sheet': sheet, 'x': x, 'y': y,
+                   'width': thumb['width'], 'height': thumb['height']}
+                  for thumb, (sheet, x, y) in zip(thumbs, positions)],
+    }
+    data = json.dumps(manifest, sort_keys=True)
+    version = hashlib.sha1(data.encode()).hexdigest()[:10]
+    root = os.path.relpath(sprite_dir(args.thumb_dir, url), args.thumb_dir)
+    for thumb, (sheet, x, y) in zip(thumbs, positions):
+        thumb['sprite'] = {'url': os.path.join(root, manifest['sheets'][sheet]['file']),
+                           'version': version, 'x': x, 'y': y}
+    return manifest
+
+
+def generate_sprite(args: argparse.Namespace, manifest: Dict,
+    sheet: int, out_file: str) -> None:
+    """Paste the thumbnails of a page onto one of its sprite sheets.
+
+    Thumbnails which do not exist are left blank.
+
+    :param args: preprocessed command line arguments.
+    :param manifest: the sprite manifest of the page, see :func:`generate_albums`.
+    :param sheet: the index of the sheet to create.
+    :param out_file: the path to save the sheet to.
+    """
+    info = manifest['sheets'][sheet]
+    mode = 'RGB' if out_file.endswith(('.jpg', '.jpeg')) else 'RGBA'
+    im = Image.new(mode, (info['width'], info['height']))
+    for tile in manifest['tiles']:
+        if tile['sheet'] != sheet:
+            continue
+        try:
+            with open_thumb(args, os.path.join(args.thumb_dir,
+                                               tile['thumb'])) as thumb:
+                thumb = thumb.convert(mode)
+        except (OSError, ValueError):
+            continue
+        size = (tile['width'], tile['height'])
+        if thumb.size != size:
+            thumb = thumb.resize(size, PRESETS[args.preset][0])
+        im.paste(thumb, (tile['x'], tile['y']))
+    save_image(im, out_file, args)
+
+
+def generate_sprites(args: argparse.Namespace, urls: Iterable[str]) -> None:
+    """Create the sprite sheets of pages which do not exist yet.
+
+    :func:`create_templates` writes a manifest for every page along with
+    the page, and removes its sheets. This function then creates the
+    missing sheets of the pages it wrote, once thumbnails have been
+    generated. Sheets of other pages, for instance if a previous run was
+    interrupted, are created on demand by :class:`OnDemandGenerator`.
+
+    :param args: preprocessed command line arguments.
+    :param urls: the URLs of the pages written by :func:`create_templates`.
+    """
+    for url in urls:
+        root = sprite_dir(args.thumb_dir, url)
+        try:
+            files = os.listdir(root)
+            with open(os.path.join(root, 'index.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for sheet, info in enumerate(manifest['sheets']):
+            if info['file'] not in files:
+                generate_sprite(args, manifest, sheet,
+                    os.path.join(root, info['file']))
+
+
+class OnDemandGenerator:
+    """Generate thumbnails as soon as they are requested by the server.
+
+    The server starts serving pages before thumbnails are generated. When
+    a thumbnail which does not exist yet is requested, this class
+    generates it immediately using :func:`generate_thumbnail`, so that the
+    request can be served. A lock per image ensures that concurrent
+    requests do not duplicate work, and the background batch will skip
+    images generated this way since their thumbnails are already fresh.
+
+    Sprite sheets are generated on demand as well, along with any of
+    their thumbnails which do not exist yet.
+
+    :param args: preprocessed command line arguments.
+    :param stats: where to record the timings of generated thumbnails.
+    """
+
+    def __init__(self, args: argparse.Namespace, stats: Stats=None):
+        self.args = args
+        self.stats = stats if stats is not None else Stats()
+        self.lock = threading.Lock()
+        self.locks = {}  # type: Dict[str, threading.Lock]
+
+    def resolve(self, path: str) -> Optional[Tuple[str, str, str, str]]:
+        """Find the original image of a thumbnail.
+
+        :param path: the absolute path of a thumbnail.
+        :return: the paths to pass on to :func:`generate_thumbnail`, or
+            ``None`` if :attr:`path` is not a thumbnail of an existing image.
+        """
+        parts = os.path.relpath(path, self.args.thumb_dir).split(os.path.sep)
+        sizes = [str(size) for size in self.args.sizes]
+        if parts[0] == 'sizes' and len(parts) > 1 and parts[1] in sizes:
+            parts = parts[2:]
+        elif parts[0] == 'small' or (parts[0] == 'large' and self.args.previews):
+            parts = parts[1:]
+        else:
+            return None
+        if not parts:
+            return None
+        *dirs, thumb = parts
+        name = source_name(thumb, self.args.thumb_format)
+        in_file = os.path.join(self.args.image_dir, *dirs, name)
+        if (not filter_image(name) or self.args.thumb_dir in in_file
+            or not os.path.isfile(in_file)):
+            return None
+        paths = (in_file,
+                 os.path.join(self.args.thumb_dir, 'small', *dirs, thumb),
+                 os.path.join(self.args.thumb_dir, 'large', *dirs, thumb),
+                 os.path.join(self.args.thumb_dir, 'full', *dirs, name))
+        return paths
+
+    def __call__(self, path: str) -> bool:
+        """Generate the thumbnail at :attr:`path` if possible.
+
+        :param path: the absolute path of a missing thumbnail.
+        :return: ``True`` if the thumbnail exists now, ``False`` otherwise.
+        """
+        sprites = os.path.join(self.args.thumb_dir, 'sprites') + os.path.sep
+        if self.args.sprites and path.startswith(sprites):
+            return self.sprite(path)
+        paths = self.resolve(path)
+        if paths is None:
+            return False
+        with self.lock:
+            lock = self.locks.setdefault(paths[0], threading.Lock())
+        with lock:
+            if thumb_mtime(self.args, path) is None:
+                out_files = [size_path(self.args, paths[1], size)
+                             for size in self.args.sizes]
+                for out_file in [*paths[1:], *out_files]:
+                    if not self.args.pack:
+                        os.makedirs(os.path.dirname(out_file), exist_ok=True)
+                timings = {}
+                result = generate_thumbnail(paths, self.args, timings)
+                self.stats.add_image(paths[0], timings,
+                                     not isinstance(result, str))
+        with self.lock:
+            self.locks.pop(paths[0], None)
+        return thumb_mtime(self.args, path) is not None
+
+    def sprite(self, path: str) -> bool:
+        """Generate the sprite sheet at :attr:`path` if possible.
+
+        :param path: the absolute path of a missing sprite sheet.
+        :return: ``True`` if the sprite sheet exists now, ``False`` otherwise.
+        """
+        root, name = os.path.split(path)
+        try:
+            with open(os.path.join(root, 'index.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        sheets = [info['file'] for info in manifest['sheets']]
+        if name not in sheets:
+            return False
+        sheet = sheets.index(name)
+        with self.lock:
+            lock = self.locks.setdefault(path, threading.Lock())
+        with lock:
+            if not os.path.exists(path):
+                for tile in manifest['tiles']:
+                    thumb = os.path.join(self.args.thumb_dir, tile['thumb'])
+                    if tile['sheet'] == sheet and thumb_mtime(self.args, thumb) is None:
+                        self(thumb)
+                generate_sprite(self.args, manifest, sheet, path)
+        with self.lock:
+            self.locks.pop(path, None)
+        return os.path.exists(path)
+
+
+def process_paths(args: argparse.Namespace, tree: Tree, index: ImageIndex,
+    folders: Iterable[Folder]=None) -> Tuple[Tuple[str, str, str, str], int, bool]:
     """Generate paths to be processed by :func:`generate_thumbnail`
 
     If :attr:`args.clean` is set, all image files within :attr:`args.image_dir`
     will be included. Else, thumbnails which already exist and are newer than 
-    the original image will be fileterd out.
+    the original image will be fileterd out. Images which :attr:`index`
+    already knows to be thumbnailed are filtered out without touching
+    the thumbnails, using the ``stat`` cached by :func:`~shis.scan.scan_tree`.
+    Thumbnails which are up to date but not in :attr:`index` yet are
+    included anyway, so that their placeholder is recorded. So are images
+    which are missing any of the sizes required by the current options.
 
     :param args: preprocessed command line arguments.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param folders: the folders to process (default: all).
     :return: a tuple of (paths, num_pages, stale).
 
         - **paths** (*tuple*) - a 4-tuple containing (1) the absolute
@@ -82,79 +546,133 @@ def process_paths(args: argparse.Namespace) -> Tuple[Tuple[str, str, str, str],
         - **num_pages** (*int*) - the number of webpages to generate.
         - **stale** (*bool*) - indicates whether a stale thumbnail was deleted.
     """
+    from tqdm import tqdm
     paths = []
     num_pages = 0
     stale = False
+    store = pack_store(args.thumb_dir) if args.pack else None
 
     if not args.quiet:
         tqdm.write(f'Processing images from : {args.image_dir}')
-        if args.clean and os.path.isdir(os.path.join(args.thumb_dir, 'small')):
+        if args.clean and (os.path.isdir(os.path.join(args.thumb_dir, 'small'))
+                           or os.path.isdir(store.root if store else '')):
             tqdm.write(f'Removing existing data : {args.thumb_dir}')
             shutil.rmtree(args.thumb_dir)
         tqdm.write(f'Creating thumbnails in : {args.thumb_dir}')
 
-    for image_root, _, files in os.walk(args.image_dir):
-        if args.thumb_dir in image_root:
-            continue
-        if image_root.count('/') > 100:
-            raise ValueError(f'Too many subdirectories: {image_root}')
+    for folder in (tree if folders is None else folders):
+        image_root, files = folder.path, folder.files
         small_root = rreplace(image_root, args.image_dir, f'{args.thumb_dir}/small')
         large_root = rreplace(image_root, args.image_dir, f'{args.thumb_dir}/large')
         full_root = rreplace(image_root, args.image_dir, f'{args.thumb_dir}/full')
-        os.makedirs(small_root, exist_ok=True)
-        os.makedirs(large_root, exist_ok=True)
-        os.makedirs(full_root, exist_ok=True)
+        size_roots = [size_path(args, small_root, size) for size in args.sizes]
+        for size_root in [small_root, large_root, full_root, *size_roots]:
+            if store is None:
+                os.makedirs(size_root, exist_ok=True)
         num_pages += 1
-        for idx, name in enumerate(filter(filter_image, files)):
+        # Thumbnails of every size which is currently required
+        listings = []
+        for root in [small_root, *([large_root] if args.previews else []),
+                     *size_roots]:
+            if store is None:
+                listings.append(set(filter(filter_image, os.listdir(root))))
+            else:
+                listings.append(store.names(root))
+        thumb_files = listings[0]
+        removed = []
+        thumb_names = set()
+        for idx, (name, entry) in enumerate(files.items()):
+            thumb = thumb_name(name, args.thumb_format)
+            thumb_names.add(thumb)
             image_path = os.path.join(image_root, name)
-            small_path = os.path.join(small_root, name)
-            large_path = os.path.join(large_root, name)
+            small_path = os.path.join(small_root, thumb)
+            large_path = os.path.join(large_root, thumb)
             full_path = os.path.join(full_root, name)
             if idx != 0 and idx % args.pagination == 0:
                 num_pages += 1
-            if not os.path.exists(small_path):
+            image_stat = entry.stat()
+            if any(thumb not in listing for listing in listings):
+                # Some outputs were never created, such as when --sizes
+                # or --previews are added to an existing website
+                paths.append((image_path, small_path, large_path, full_path))
+            elif index.has_thumb(image_path, image_stat):
+                continue
+            elif (thumb_mtime(args, small_path) or 0) < image_stat.st_mtime_ns:
+                # Pages will link to a new version of these thumbnails, so
+                # remove them to have the server generate them on demand
+                removed.extend(os.path.join(size_root, thumb) for size_root
+                               in [small_root, large_root, *size_roots])
                 paths.append((image_path, small_path, large_path, full_path))
-            elif os.path.getmtime(small_path) < os.path.getmtime(image_path):
+            else:
+                # Only the placeholder is missing from the index
                 paths.append((image_path, small_path, large_path, full_path))
         # Make a list of thumbnails that have to be deleted
-        thumb_files = filter(filter_image, os.listdir(small_root))
-        stale_files = list(set(thumb_files) - set(files))
+        stale_files = list(thumb_files - thumb_names)
         stale = True if stale_files else stale
-        for name in stale_files:
-            for size_root in [small_root, large_root, full_root]:
-                size_path = os.path.join(size_root, name)
-                os.remove(size_path) if os.path.isfile(size_path) else None
+        for thumb in stale_files:
+            name = source_name(thumb, args.thumb_format)
+            removed.extend(os.path.join(size_root, thumb) for size_root
+                           in [small_root, large_root, *size_roots])
+            if name not in files:
+                full_path = os.path.join(full_root, name)
+                os.remove(full_path) if os.path.lexists(full_path) else None
+                index.remove(os.path.join(image_root, name))
+        if store is not None:
+            store.remove(removed)
+            store.compact(small_root)
+        else:
+            for old_path in removed:
+                os.remove(old_path) if os.path.isfile(old_path) else None
+    index.commit()
     return paths, num_pages, stale
 
 
-def generate_albums(args: argparse.Namespace) -> Tuple[Dict, int]:
+def generate_albums(args: argparse.Namespace, tree: Tree, index: ImageIndex,
+    folders: Iterable[Folder]=None, static_version: str='') -> Tuple[Dict, int]:
     """Generate data required to populate Jinja2 templates.
 
     This function generates the correct names and URLs for all 
     thumbnails, albums, breadcrumbs and previews required for
-    populating each HTML page of the website.
+    populating each HTML page of the website. Image dimensions are
+    looked up in :attr:`index` and only read from disk if needed.
 
     :param args: preprocessed command line arguments.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param folders: the folders to generate albums for (default: all).
+    :param static_version: the version of the static files.
     :return: a generator which yields data required to populate each page.
     """
     small_base = os.path.join(args.thumb_dir, 'small')
-    image_head, image_tail = os.path.split(args.image_dir)
+    # Thumbnails are versioned by the mtime of the original image and the
+    # options used to create them
+    options = [args.thumb_size, args.preview_size, args.previews,
+               args.sizes, args.thumb_format, args.quality, args.preset]
+    options = hashlib.sha1(json.dumps(options).encode()).hexdigest()[:6]
 
-    for index_root, folders, files in os.walk(args.image_dir):
-        if args.thumb_dir in index_root:
-            continue
+    for index_folder in (tree if folders is None else folders):
+        index_root = index_folder.path
         small_root = rreplace(index_root, args.image_dir, small_base)
         full_root = rreplace(small_root, 'small', 'full')
         large_root = rreplace(small_root, 'small', 'large')
-        slug_name = os.path.relpath(index_root, image_head)
-        slug_path = rreplace(slug_name, image_tail, 'html')
+        slug_name, slug_path = slugify(index_root, args.image_dir)
 
         if not args.previews:
             large_root = full_root
+        # Thumbnails of an album only differ by name, so their paths
+        # relative to args.thumb_dir are computed once per album
+        small_rel = os.path.relpath(small_root, args.thumb_dir)
+        large_rel = os.path.relpath(large_root, args.thumb_dir)
+        full_rel = os.path.relpath(full_root, args.thumb_dir)
+        size_rels = {size: os.path.relpath(size_path(args, small_root, size),
+                                           args.thumb_dir)
+                     for size in args.sizes}
+        size_rels[args.thumb_size] = small_rel
 
         name = os.path.basename(slug_name)
         album = {'name': name}
-        files = list(filter(filter_image, files))
+        files = list(index_folder.files)
+        folders = list(index_folder.folders)
 
         # Breadcrumbs
         crumbs = []
@@ -179,15 +697,21 @@ def generate_albums(args: argparse.Namespace) -> Tuple[Dict, int]:
         albums = []
         for folder_name in folders:
             album_path = os.path.join(index_root, folder_name)
-            if args.thumb_dir in album_path:
+            if album_path not in tree:
                 continue
-            album_size = len(os.listdir(album_path))
-            image_root = os.path.join(small_root, folder_name)
-            image = find_thumb(album_path, image_root, args.thumb_dir)
+            album_size = tree[album_path].size
+            image = tree.cover(album_path)
+            version = ''
+            if image:
+                version = f'{tree.stat(image).st_mtime_ns:x}{options}'
+                image_path = rreplace(image, args.image_dir, small_base)
+                image_path = os.path.join(os.path.dirname(image_path),
+                    thumb_name(os.path.basename(image_path), args.thumb_format))
+                image = os.path.relpath(image_path, args.thumb_dir)
 
             album_slug_path = os.path.join(slug_path, folder_name)
             url = urlify(album_slug_path)
-            folder = {'image': image, 'url': url,
+            folder = {'image': image, 'url': url, 'version': version,
                       'name': folder_name, 'size': album_size}
             albums.append(folder)
         album['albums'] = albums
@@ -206,27 +730,47 @@ def generate_albums(args: argparse.Namespace) -> Tuple[Dict, int]:
         album['revpath'] = os.path.relpath('.', album['url'])
         album['selection'] = args.selection
         album['start_idx'] = 0
+        album['version'] = static_version
+        album['sprites'] = None
 
         # Images
         for page, chunk in enumerate(chunks(files, args.pagination)):
             thumbs = []
             for name in chunk:
-                small_path = os.path.join(small_root, name)
-                large_path = os.path.join(large_root, name)
-                full_path = os.path.join(full_root, name)
+                thumb = thumb_name(name, args.thumb_format)
                 real_path = os.path.join(index_root, name)
                 try:
-                    width, height = imagesize.get(real_path)
-                except ValueError:
+                    real_stat = tree.stat(real_path)
+                    real_width, real_height = index.dims(real_path, real_stat)
+                except (OSError, ValueError):
                     continue
-                width, height = scale_dims(width, height, args.thumb_size)
-                small = os.path.relpath(small_path, args.thumb_dir)
-                large = os.path.relpath(large_path, args.thumb_dir)
-                full = os.path.relpath(full_path, args.thumb_dir)
+                width, height = scale_dims(real_width, real_height,
+                    args.thumb_size)
+                small = os.path.join(small_rel, thumb)
+                large = os.path.join(large_rel,
+                                     thumb if args.previews else name)
+                full = os.path.join(full_rel, name)
+                # Candidates for srcset, since images are never upscaled
+                # some sizes may turn out to be identical
+                srcset, widths = [], set()
+                for size in sorted(size_rels):
+                    url = os.path.join(size_rels[size], thumb)
+                    size = min(size, real_width, real_height)
+                    size_width, _ = scale_dims(real_width, real_height, size)
+                    if args.sizes and size_width not in widths:
+                        srcset.append({'url': url, 'width': size_width})
+                        widths.add(size_width)
+                version = f'{real_stat.st_mtime_ns:x}{options}'
                 thumb = {'name': name, 'small': small, 'large': large,
-                         'full': full, 'width': width, 'height': height}
+                         'full': full, 'width': width, 'height': height,
+                         'srcset': srcset, 'version': version,
+                         'placeholder': index.placeholder(real_path, real_stat)}
                 thumbs.append(thumb)
             album['thumbs'] = thumbs
+            album['sprites'] = None
+            if args.sprites and thumbs:
+                album['sprites'] = sprite_manifest(args,
+                    pagination[page]['url'], thumbs)
             if page > 0:
                 album['pagination'][page - 1]['current'] = None
                 album['start_idx'] = page * args.pagination
@@ -240,55 +784,565 @@ def generate_albums(args: argparse.Namespace) -> Tuple[Dict, int]:
             yield album, 0
 
 
-def create_templates(args: argparse.Namespace, num_pages: int) -> None:
+def grid_manifest(album: Dict) -> Dict:
+    """Describe an album for the virtualized grid of :attr:`args.grid`.
+
+    The manifest is the JSON counterpart of the data passed on to the
+    ``index.html`` template, for ``static/grid.js`` to render in the
+    browser. To keep it compact, each thumbnail is a list of (name, width,
+    height, version, small, large, full, srcset, placeholder), and every
+    path is split into an index into ``roots`` and a file name, since all
+    images of an album share a handful of directories.
+
+    :param album: the data of the only page of an album, see
+        :func:`generate_albums`.
+    :return: the manifest of the album.
+    """
+    roots = {}  # type: Dict[str, int]
+
+    def split(path):
+        root, name = os.path.split(path)
+        return [roots.setdefault(root, len(roots)), name]
+
+    thumbs = [[thumb['name'], thumb['width'], thumb['height'], thumb['version'],
+               split(thumb['small']), split(thumb['large']), split(thumb['full']),
+               [[*split(src['url']), src['width']] for src in thumb['srcset']],
+               thumb['placeholder']]
+              for thumb in album.get('thumbs', [])]
+    return {'name': album['name'], 'crumbs': album['crumbs'],
+            'albums': album['albums'], 'group': album['group'],
+            'roots': list(roots), 'thumbs': thumbs}
+
+
+def album_digest(args: argparse.Namespace, tree: Tree, index: ImageIndex,
+    folder: Folder, salt: str) -> str:
+    """Compute a digest of everything that the pages of an album depend on.
+
+    This includes the name, ``mtime``, size and whether there is a
+    placeholder for every image in :attr:`folder`, the size and cover of
+    every subalbum along with the ``mtime`` of the cover, and the command
+    line arguments in :data:`PAGE_OPTIONS`. If the digest of an album is
+    unchanged since the last run, none of its pages need to be rendered
+    again.
+
+    :param args: preprocessed command line arguments.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param folder: the folder to compute the digest of.
+    :param salt: an additional string to include in the digest.
+    :return: a hex digest.
+    """
+    files = [(name, entry.stat().st_mtime_ns, entry.stat().st_size,
+              index.has_thumb(entry.path, entry.stat()))
+             for name, entry in folder.files.items()]
+    folders = []
+    for name in folder.folders:
+        path = os.path.join(folder.path, name)
+        if path in tree:
+            cover = tree.cover(path)
+            cover_mtime = tree.stat(cover).st_mtime_ns if cover else 0
+            folders.append((name, tree[path].size, cover, cover_mtime))
+    options = {k: getattr(args, k) for k in PAGE_OPTIONS}
+    data = json.dumps([salt, files, folders, options], default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+def remove_page(thumb_dir: str, url: str) -> None:
+    """Remove a page which is no longer needed along with empty parents.
+
+    :param thumb_dir: the path to the generated website.
+    :param url: the URL of the page, relative to :attr:`thumb_dir`.
+    """
+    html_dir = os.path.join(thumb_dir, 'html')
+    page_dir = os.path.join(thumb_dir, url)
+    for name in ['index.html', 'index.json']:
+        path = os.path.join(page_dir, name)
+        for path in [path, *(path + ext for ext, _ in ENCODERS)]:
+            if os.path.isfile(path):
+                os.remove(path)
+    while page_dir.startswith(html_dir + os.path.sep):
+        try:
+            os.rmdir(page_dir)
+        except OSError:
+            break
+        page_dir = os.path.dirname(page_dir)
+
+
+def remove_sprites(thumb_dir: str, url: str) -> None:
+    """Remove the sprite sheets and manifest of a page along with empty parents.
+
+    :param thumb_dir: the path to the generated website.
+    :param url: the URL of the page, relative to :attr:`thumb_dir`.
+    """
+    sprites_dir = os.path.join(thumb_dir, 'sprites')
+    root = sprite_dir(thumb_dir, url)
+    if not os.path.isdir(root):
+        return
+    for entry in os.scandir(root):
+        os.remove(entry.path) if entry.is_file() else None
+    while root.startswith(sprites_dir + os.path.sep):
+        try:
+            os.rmdir(root)
+        except OSError:
+            break
+        root = os.path.dirname(root)
+
+
+# Templates compiled by this process, see load_template
+templates = {}  # type: Dict[str, Template]
+
+
+def load_template(name: str) -> 'Template':
+    """Load a template of the website, compiling it only once per process.
+
+    :param name: the name of the template inside :data:`TEMPLATE_DIR`.
+    :return: the compiled Jinja2 template.
+    """
+    template = templates.get(name)
+    if template is None:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        env = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            autoescape=select_autoescape(['html', 'xml'])
+        )
+        template = templates[name] = env.get_template(name)
+    return template
+
+
+def compress_page(args: argparse.Namespace, url: str) -> None:
+    """Write compressed copies of a page, see :func:`~shis.utils.precompress`.
+
+    :param args: preprocessed command line arguments.
+    :param url: the URL of the page, relative to :attr:`args.thumb_dir`.
+    """
+    page_dir = os.path.join(args.thumb_dir, url)
+    precompress(os.path.join(page_dir, 'index.html'))
+    if args.grid:
+        precompress(os.path.join(page_dir, 'index.json'))
+
+
+def render_pages(args: argparse.Namespace, context: Dict,
+    pages: List[Tuple[int, Dict]]) -> None:
+    """Render pages of an album and write them to :attr:`args.thumb_dir`.
+
+    The data of each page is split into :attr:`context`, which is shared by
+    every page of the album, and the values of :data:`PAGE_KEYS` for each
+    page. This way, the context is only sent once along with a batch of
+    pages when they are rendered by a worker.
+
+    Pages showing images without a placeholder are rendered again once
+    their thumbnails have been generated, so they are only compressed
+    by :func:`main` at the end of the cycle, see :func:`compress_page`.
+
+    :param args: preprocessed command line arguments.
+    :param context: the data common to all pages of the album, as
+        generated by :func:`generate_albums` minus :data:`PAGE_KEYS`.
+    :param pages: a list of tuples containing the index of each page and
+        its values of :data:`PAGE_KEYS`.
+    """
+    template = load_template('grid.html' if args.grid else 'index.html')
+    for page, values in pages:
+        album = dict(context, **values)
+        album['pagination'] = [dict(item,
+            current=None if idx < page else 'current' if idx == page else '')
+            for idx, item in enumerate(context['pagination'])]
+        url = album['pagination'][page]['url']
+        html = f'{args.thumb_dir}/{url}/index.html'
+        os.makedirs(os.path.dirname(html), exist_ok=True)
+        if args.grid:
+            manifest = os.path.join(os.path.dirname(html), 'index.json')
+            atomic_write(manifest, json.dumps(grid_manifest(album),
+                separators=(',', ':')))
+        rendered = template.render(album=album)
+        try:
+            with open(html) as f:
+                unchanged = args.grid and f.read() == rendered
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            atomic_write(html, rendered)
+        if all(thumb['placeholder'] for thumb in album.get('thumbs', [])):
+            compress_page(args, url)
+        # Sheets are created later by generate_sprites
+        remove_sprites(args.thumb_dir, url)
+        if album['sprites']:
+            manifest = os.path.join(
+                sprite_dir(args.thumb_dir, url), 'index.json')
+            os.makedirs(os.path.dirname(manifest), exist_ok=True)
+            atomic_write(manifest, json.dumps(album['sprites']))
+
+
+def create_templates(args: argparse.Namespace, num_pages: int, tree: Tree,
+    index: ImageIndex, folders: Iterable[Folder]=None,
+    pool: 'ProcessPoolExecutor'=None) -> List[str]:
     """Generate HTML files and corresponding directories for the website.
 
     This function creates ``static`` and ``html`` directories inside
-    :attr:`args.thumb_dir`. If the directories already exist, they will be 
-    cleared before continuing. All static content (JS/CSS) is stored 
+    :attr:`args.thumb_dir`. All static content (JS/CSS) is stored 
     in :attr:`args.thumb_dir` ``/static`` and all HTML files (except 
     ``index.html``) are stored in :attr:`args.thumb_dir` ``/html``. 
     The data required to populate Jinja2 templates is obtained 
     from :func:`generate_albums`.
 
+    Existing files are updated in place. Static files are only copied if
+    they have changed, albums are only regenerated if their
+    :func:`album_digest` has changed, and pages are only written if their
+    contents differ from the last run. Since an album's digest includes
+    the size and cover of its subalbums, ancestors of a changed album are
+    regenerated as required. All files are written atomically, and pages
+    which no longer exist are removed. If :attr:`folders` is given, only
+    those folders and their ancestors are considered for regeneration.
+
+    If :attr:`args.grid` is set, every album is a single page, for which
+    a :func:`grid_manifest` is written next to a shell page rendered from
+    ``grid.html``. The shell only depends on the depth of the album, so
+    it is rarely written again.
+
+    Pages which need to be written are rendered by :func:`render_pages`,
+    in batches of up to :data:`RENDER_BATCH` pages of the same album. If
+    :attr:`pool` is given and the website has more than a single batch of
+    pages, batches are rendered by its workers while the data for the
+    following pages is being generated. Otherwise they are rendered right
+    away.
+
     :param args: preprocessed command line arguments.
     :param num_pages: number of HTML files (pages) to create.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param folders: the folders which have changed (default: all).
+    :param pool: a pool of workers initialized with :func:`init_worker`.
+    :return: the URLs of the pages which were written.
     """
+    from concurrent.futures import FIRST_COMPLETED, Future, wait
+    from tqdm import tqdm
     # Copy JS/CSS
-    template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-    static_src = os.path.join(template_dir, 'static')
+    static_src = os.path.join(TEMPLATE_DIR, 'static')
     static_dest = os.path.join(args.thumb_dir, 'static')
     html_dir = os.path.join(args.thumb_dir, 'html')
-    # Remove existing directories
-    if os.path.exists(static_dest):
-        shutil.rmtree(static_dest)
-    if os.path.exists(html_dir):
-        shutil.rmtree(html_dir)
-    shutil.copytree(static_src, static_dest)
-    os.makedirs(html_dir)
-    # Generate fresh HTML
-    env = Environment(
-        loader=FileSystemLoader(template_dir),
-        autoescape=select_autoescape(['html', 'xml'])
-    )
-
-    with tqdm(generate_albums(args),
-        desc="Generating Website     ", total=num_pages, ncols=100,
+    sync_dir(static_src, static_dest)
+    for entry in os.scandir(static_dest):
+        precompress(entry.path) if entry.is_file() else None
+    static_version = hash_dir(static_src)
+    os.makedirs(html_dir, exist_ok=True)
+    # Generate HTML for albums which have changed
+    template = 'grid.html' if args.grid else 'index.html'
+    with open(os.path.join(TEMPLATE_DIR, template), 'rb') as f:
+        salt = hashlib.sha1(f.read()).hexdigest() + static_version
+    # Render pages again if the available compressed copies change
+    salt += ''.join(ext for ext, _ in ENCODERS)
+    seen = set()
+    albums = tree
+    if folders is not None:
+        changed = set()
+        for folder in folders:
+            path = folder.path
+            while path.startswith(args.image_dir) and path not in changed:
+                changed.add(path)
+                path = os.path.dirname(path)
+        albums = [folder for folder in tree if folder.path in changed]
+        for folder in tree:
+            _, slug_path = slugify(folder.path, args.image_dir)
+            seen.add(urlify(slug_path).strip('/'))
+
+    # Starting workers is not worth it for a handful of pages
+    if args.ncpus < 2 or num_pages <= RENDER_BATCH:
+        pool = None
+    # Pages being rendered by workers, along with how to record them
+    pending = {}  # type: Dict[Future, List[Tuple[str, str, str]]]
+    written = []  # type: List[str]
+    with tqdm(desc="Generating Website     ", total=num_pages, ncols=100,
         bar_format=("{l_bar}{bar:20}| {n_fmt:>5}/{total_fmt:>5} "
         "[{elapsed}<{remaining}, {rate_fmt:>10}{postfix}]")) as pbar:
-        for album, page in generate_albums(args):
-            template = env.get_template('index.html')
-            url = album['pagination'][page]['url']
-            html = f'{args.thumb_dir}/{url}/index.html'
-            html_dir = os.path.dirname(html)
-            if not os.path.isdir(html_dir):
-                os.makedirs(html_dir, exist_ok=True)
-            template.stream(album=album).dump(html)
+
+        def record(records: List[Tuple[str, str, str]]) -> None:
+            # Pages are only recorded in the index once they are written
+            for url, album_url, page_digest in records:
+                index.set_page(url, album_url, page_digest)
+                written.append(url)
             # Handle tqdm when files are still being added
-            pbar.update(1)
+            pbar.update(len(records))
             if pbar.n > pbar.total:
                 pbar.total = pbar.n
 
+        for folder in albums:
+            _, slug_path = slugify(folder.path, args.image_dir)
+            album_url = urlify(slug_path).strip('/')
+            seen.add(album_url)
+            digest = album_digest(args, tree, index, folder, salt)
+            old_digest, old_pages = index.album(album_url)
+            first_page = os.path.join(args.thumb_dir, album_url, 'index.html')
+            if old_digest == digest and os.path.exists(first_page):
+                pbar.update(old_pages)
+                continue
+            urls, stale = [], []
+            for album, page in generate_albums(args, tree, index, [folder],
+                static_version):
+                url = album['pagination'][page]['url']
+                urls.append(url)
+                data = json.dumps([salt, album], sort_keys=True)
+                page_digest = hashlib.sha1(data.encode()).hexdigest()
+                html = f'{args.thumb_dir}/{url}/index.html'
+                if index.page(url) != page_digest or not os.path.exists(html):
+                    values = {key: album[key] for key in PAGE_KEYS if key in album}
+                    stale.append(((page, values), (url, album_url, page_digest)))
+                else:
+                    pbar.update(1)
+                    if pbar.n > pbar.total:
+                        pbar.total = pbar.n
+            # Everything else is the same for every page of the album
+            context = {key: value for key, value in album.items()
+                       if key not in PAGE_KEYS}
+            for batch in chunks(stale, RENDER_BATCH):
+                pages, records = zip(*batch)
+                if pool is None:
+                    render_pages(args, context, pages)
+                    record(records)
+                    continue
+                pending[pool.submit(render_batch, context, pages,
+                    task_args(args))] = records
+                while len(pending) >= 2 * args.ncpus:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                        record(pending.pop(future))
+            for url in set(index.album_pages(album_url)) - set(urls):
+                remove_page(args.thumb_dir, url)
+                remove_sprites(args.thumb_dir, url)
+                index.remove_page(url)
+            index.set_album(album_url, digest, len(urls))
+        for future, records in pending.items():
+            future.result()
+            record(records)
+        # Remove albums which no longer exist
+        for album_url in set(index.albums()) - seen:
+            for url in index.album_pages(album_url):
+                remove_page(args.thumb_dir, url)
+                remove_sprites(args.thumb_dir, url)
+            index.remove_album(album_url)
+    index.commit()
+    return written
+
+
+# Command line arguments of worker processes, set by init_worker
+worker_args = None
+
+
+def init_worker(args: argparse.Namespace) -> None:
+    """Initialize a worker process of the pool created by :func:`main`.
+
+    The command line arguments are sent to each worker only once, when it
+    starts, instead of with every task. Workers ignore ``SIGINT`` so that
+    only the main process handles ``KeyboardInterrupt``. Pack stores
+    inherited from the main process are discarded.
+
+    Without :data:`POOL_INITIALIZER`, the arguments are sent along with
+    every task instead, and each worker initializes itself on its first
+    task, see :func:`task_args`.
+
+    :param args: preprocessed command line arguments.
+    """
+    global worker_args
+    worker_args = args
+    pack.forget_stores()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def task_args(args: argparse.Namespace) -> Optional[argparse.Namespace]:
+    """Get the command line arguments to send along with a task.
+
+    :param args: preprocessed command line arguments.
+    :return: ``None`` if workers were given :attr:`args` by
+        :func:`init_worker` when they started, :attr:`args` otherwise.
+    """
+    return None if POOL_INITIALIZER else args
+
+
+def generate_batch(batch: List[Tuple[str, str, str, str]],
+                   args: argparse.Namespace=None) -> List[Tuple]:
+    """Run :func:`generate_thumbnail` on a batch of paths in a worker.
+
+    :param batch: a list of paths from :func:`process_paths`.
+    :param args: preprocessed command line arguments, see :func:`task_args`.
+    :return: a tuple for each path, containing the value returned by
+        :func:`generate_thumbnail` and the timings it recorded.
+    """
+    if args is not None and worker_args is None:
+        init_worker(args)
+    outcomes = []
+    for paths in batch:
+        timings = {}
+        outcomes.append((generate_thumbnail(paths, worker_args, timings), timings))
+    return outcomes
+
+
+def render_batch(context: Dict, pages: List[Tuple[int, Dict]],
+                 args: argparse.Namespace=None) -> None:
+    """Run :func:`render_pages` on a batch of pages in a worker.
+
+    :param context: the data common to all pages of the album.
+    :param pages: the pages to render, see :func:`render_pages`.
+    :param args: preprocessed command line arguments, see :func:`task_args`.
+    """
+    if args is not None and worker_args is None:
+        init_worker(args)
+    render_pages(worker_args, context, pages)
+
+
+def generate_thumbnails(args: argparse.Namespace, tree: Tree,
+    paths: List[Tuple[str, str, str, str]], scheduler: Scheduler,
+    pool: 'ProcessPoolExecutor', batch_time: float=0.5,
+    stats: Stats=None) -> List:
+    """Generate thumbnails for :attr:`paths` using a pool of workers.
+
+    All paths are queued in :attr:`scheduler` along with the album and page
+    they appear on. Rather than handing all paths to the pool up front,
+    only a few tasks are kept in flight, and every time a worker becomes
+    free it receives the items with the highest priority at that moment.
+    This way, pages viewed on the website are always processed first.
+
+    Each task is a batch of paths. The size of a batch adapts to the
+    time taken per image so that each task takes about :attr:`batch_time`
+    seconds, which keeps the overhead of dispatching tasks low for small
+    images while staying responsive to changes in priority.
+
+    :param args: preprocessed command line arguments.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param paths: the paths returned by :func:`process_paths`.
+    :param scheduler: the queue to schedule paths with.
+    :param pool: a pool of workers initialized with :func:`init_worker`.
+    :param batch_time: the target duration of each task in seconds.
+    :param stats: where to record the timings of each image.
+    :return: the values returned by :func:`generate_thumbnail` for each path.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+    from tqdm import tqdm
+    positions = {}
+    for item in paths:
+        root, name = os.path.split(item[0])
+        if root not in positions:
+            names = list(tree[root].files)
+            if args.order == 'name':
+                names = sorted(names)
+            positions[root] = {name: idx for idx, name in enumerate(names)}
+        scheduler.push(item, root, positions[root][name] // args.pagination)
+
+    results = {}
+    start, done_count = time.monotonic(), 0
+    with tqdm(total=len(paths), unit_scale=True,
+        desc='Generating Thumbnails  ', ncols=100,
+        bar_format=("{l_bar}{bar:20}| {n_fmt:>5}/{total_fmt:>5} "
+        "[{elapsed}<{remaining}, {rate_fmt:>10}{postfix}]")) as pbar:
+        pending = {}
+        while True:
+            while len(pending) < 2 * args.ncpus:
+                # Seconds per image for a single worker, so far
+                elapsed = (time.monotonic() - start) * args.ncpus
+                batch_size = 1
+                if done_count:
+                    batch_size = int(batch_time * done_count / elapsed)
+                batch_size = min(batch_size, len(scheduler) // args.ncpus, 64)
+                batch = scheduler.pop_many(max(batch_size, 1))
+                if not batch:
+                    break
+                pending[pool.submit(generate_batch, batch,
+                    task_args(args))] = batch
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = pending.pop(future)
+                for item, (result, timings) in zip(batch, future.result()):
+                    results[item] = result
+                    if stats is not None:
+                        stats.add_image(item[0], timings,
+                                        not isinstance(result, str))
+                done_count += len(batch)
+                pbar.update(len(batch))
+    return [results.get(item) for item in paths]
+
+
+def link_duplicates(args: argparse.Namespace, tree: Tree, index: ImageIndex,
+    paths: List[Tuple[str, str, str, str]], duplicates: Dict[str, str],
+    results: Dict[str, object], seconds: float=0.0) -> List:
+    """Give duplicate images the thumbnails of their canonical image.
+
+    Every thumbnail of the canonical image is hard linked to the path of
+    the same thumbnail of each duplicate using
+    :func:`~shis.utils.atomic_link`. If :attr:`args.pack` is set, the
+    thumbnails are copied within the pack files instead. Download links
+    still point to the duplicate itself.
+
+    :param args: preprocessed command line arguments.
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param paths: the paths returned by :func:`process_paths`.
+    :param duplicates: the duplicates found by
+        :func:`~shis.dedup.find_duplicates`.
+    :param results: the values returned by :func:`generate_thumbnail`,
+        keyed by the path of each image which was not a duplicate.
+    :param seconds: the CPU time spent per thumbnailed image, used to
+        report how much time was saved.
+    :return: the values returned by :func:`generate_thumbnail` for each
+        path, as if every duplicate had been thumbnailed too.
+    """
+    from tqdm import tqdm
+    store = pack_store(args.thumb_dir) if args.pack else None
+    for item in paths:
+        source = duplicates.get(item[0])
+        if source is None:
+            continue
+        result = results.get(source)
+        if result is None:
+            # The canonical image already had up to date thumbnails
+            result = index.placeholder(source, tree.stat(source))
+        if isinstance(result, str):
+            src, dst = thumb_paths(args, source), item
+            outputs = [(src[1], dst[1])]
+            outputs.extend((size_path(args, src[1], size),
+                            size_path(args, dst[1], size)) for size in args.sizes)
+            if args.previews:
+                outputs.append((src[2], dst[2]))
+            try:
+                for src_file, dst_file in outputs:
+                    if store is None:
+                        atomic_link(src_file, dst_file)
+                        continue
+                    packed = store.read(src_file)
+                    if packed is None:
+                        raise FileNotFoundError(src_file)
+                    store.write(dst_file, bytes(packed[0]))
+                if store is None and not os.path.lexists(dst[3]):
+                    full_dest = os.path.relpath(dst[0], os.path.dirname(dst[3]))
+                    os.symlink(full_dest, dst[3])
+            except OSError as e:
+                result = e
+        results[item[0]] = result
+    if duplicates and not args.quiet:
+        saved = f', saving about {seconds * len(duplicates):.1f} CPU seconds'
+        tqdm.write(f'Skipped duplicates     : {len(duplicates)} images'
+                   f'{saved if seconds else ""}')
+    return [results.get(item[0]) for item in paths]
+
+
+def record_thumbnails(tree: Tree, index: ImageIndex,
+    paths: List[Tuple[str, str, str, str]], results: List) -> List[Folder]:
+    """Record successfully generated thumbnails and placeholders in :attr:`index`.
+
+    :param tree: the scanned contents of :attr:`args.image_dir`.
+    :param index: the image metadata index for :attr:`args.thumb_dir`.
+    :param paths: the paths passed to :func:`generate_thumbnail`.
+    :param results: the values returned by :func:`generate_thumbnail`.
+    :return: the folders which have new placeholders.
+    """
+    folders = {}
+    for (in_file, *_), result in zip(paths, results):
+        root = os.path.dirname(in_file)
+        if isinstance(result, str) and root in tree:
+            index.set_thumb(in_file, tree.stat(in_file), result)
+            folders[root] = tree[root]
+    index.commit()
+    return list(folders.values())
+
 
 def preprocess_args(args: argparse.Namespace) -> argparse.Namespace:
     """Preprocess arguments parsed by argparse.
@@ -306,6 +1360,11 @@ def preprocess_args(args: argparse.Namespace) -> argparse.Namespace:
         os.getcwd(), args.thumb_dir)).rstrip(os.path.sep)
     if args.group:
         args.pagination += args.group - (args.pagination % args.group)
+    if args.grid:
+        # Albums are never split into pages, and sheets would be huge
+        args.pagination = sys.maxsize
+        args.sprites = False
+    args.sizes = sorted(set(args.sizes) - {args.thumb_size})
     return args
 
 
@@ -314,36 +1373,125 @@ def main(args: argparse.Namespace) -> None:
 
     :param args: command line arguments parsed by argparse.
     """
+    from tqdm import tqdm
     args = preprocess_args(args)
+    stats = Stats()
+    index = ImageIndex(args.thumb_dir)
+    index.stats = stats
+    scheduler = Scheduler(args)
+    server, pool = None, None
+    folders, watcher, polling = None, None, args.poll
     # Start the server process
     try:
         server = start_server(args)
+        # Worker processes are only started once they are given work
+        from concurrent.futures import ProcessPoolExecutor
+        if POOL_INITIALIZER:
+            pool = ProcessPoolExecutor(max_workers=args.ncpus,
+                initializer=init_worker, initargs=(args,))
+        else:
+            pool = ProcessPoolExecutor(max_workers=args.ncpus)
+        server.resolver.on_demand = OnDemandGenerator(args, stats)
+        server.resolver.on_view = scheduler.view
+        server.resolver.metrics.register('shis_thumbnail_queue_depth', 'gauge',
+            'Images waiting to be thumbnailed.', lambda: len(scheduler))
+        server.resolver.metrics.register('shis_thumbnails_total', 'counter',
+            'Images thumbnailed since the server started.', lambda: stats.images)
+        if server.resolver.cache is not None:
+            utils.replace_hooks.append(server.resolver.cache.invalidate)
         stale_paths = []
         while True:
+            # Scan everything, unless we know exactly what has changed
+            if folders is None:
+                with stats.stage('scan'):
+                    tree = scan_tree(args)
+                if args.pack:
+                    # Only serve originals which are part of the website
+                    server.resolver.alias_filter = tree.has_image
+                if args.watch and not polling and watcher is None:
+                    try:
+                        watcher = Watcher(args, tree.folders)
+                    except OSError as error:
+                        tqdm.write(f'Falling back to polling: {error}')
+                        polling = True
             # Generate HTML pages
-            paths, num_pages, stale = process_paths(args)
+            with stats.stage('process'):
+                paths, num_pages, stale = process_paths(args, tree, index, folders)
             new_paths = list(set(paths) - set(stale_paths))
-            if new_paths or stale:
-                create_templates(args, num_pages)
+            # Pages written in this cycle, whose sprite sheets were removed
+            written = []  # type: List[str]
+            if new_paths or stale or folders:
+                with stats.stage('render'):
+                    written += create_templates(args, num_pages, tree, index,
+                        folders, pool)
             # Generate thumbnails
             if paths:
-                process_map(generate_thumbnail, paths, repeat(args),
-                    chunksize=1, max_workers=args.ncpus, unit_scale=True,
-                    desc='Generating Thumbnails  ', ncols=100,
-                    bar_format=("{l_bar}{bar:20}| {n_fmt:>5}/{total_fmt:>5} "
-                    "[{elapsed}<{remaining}, {rate_fmt:>10}{postfix}]"))
+                duplicates = {}
+                if args.dedup:
+                    with stats.stage('dedup'):
+                        duplicates = find_duplicates(tree, index,
+                            [item[0] for item in paths])
+                unique = [item for item in paths if item[0] not in duplicates]
+                results, seconds = [], 0.0
+                if unique:
+                    images, cpu = stats.images, sum(stats.seconds.values())
+                    with stats.stage('thumbnails'):
+                        results = generate_thumbnails(args, tree, unique,
+                            scheduler, pool, stats=stats)
+                    # Average time spent by a worker on each image
+                    seconds = ((sum(stats.seconds.values()) - cpu) /
+                               max(stats.images - images, 1))
+                results = link_duplicates(args, tree, index, paths, duplicates,
+                    {item[0]: result for item, result in zip(unique, results)},
+                    seconds)
+                updated = record_thumbnails(tree, index, paths, results)
+                # Render pages again to include the new placeholders
+                if updated:
+                    with stats.stage('render'):
+                        written += create_templates(args, num_pages, tree,
+                            index, updated, pool)
+            # Compress pages which still lack placeholders, for instance
+            # since some of their thumbnails could not be generated
+            with stats.stage('render'):
+                for url in dict.fromkeys(written):
+                    compress_page(args, url)
+            if args.sprites and written:
+                with stats.stage('sprites'):
+                    generate_sprites(args, dict.fromkeys(written))
+            if args.stats:
+                stats.write(args.stats)
             stale_paths = paths
             args.quiet = True
             if not args.watch:
                 break
-            else:
+            folders = None
+            if watcher is None:
                 time.sleep(args.watch)
+                continue
+            try:
+                changed = watcher.wait()
+            except OSError as error:
+                tqdm.write(f'Falling back to polling: {error}')
+                changed, polling = None, True
+            if changed is None:
+                # Events were lost, start over with a full scan
+                watcher.close()
+                watcher = None
+            else:
+                with stats.stage('scan'):
+                    folders = tree.update(changed)
         while True:
             # Loop until a KeyboardInterrupt is received
             time.sleep(1)
     except KeyboardInterrupt:
         print('\nKeyboard interrupt received, exiting.')
-        server.shutdown()
+        if server is not None:
+            server.shutdown()
+        if pool is not None:
+            pool.shutdown(wait=False)
+        index.close()
+        if watcher is not None:
+            watcher.close()
         if args.clean and os.path.isdir(args.thumb_dir):
             tqdm.write(f'Removing existing data : {args.thumb_dir}')
             shutil.rmtree(args.thumb_dir)
@@ -356,6 +1504,11 @@ def make_parser() -> argparse.ArgumentParser:
     :return: a parser with the specified options.
     """
 
+    # Only offer formats which the installed version of Pillow can write
+    extensions = Image.registered_extensions()
+    thumb_formats = [thumb_format for thumb_format, exts in THUMB_FORMATS.items()
+                     if extensions.get(exts[0]) in Image.SAVE]
+
     parser = argparse.ArgumentParser(
         prog='python -m shis.server', 
         description='A drop in replacement for python -m http.server, albeit for images.',
@@ -366,12 +1519,23 @@ def make_parser() -> argparse.ArgumentParser:
         help='enable selection mode on the website')
     parser.add_argument('-p', '--port', type=int, default=None,
         help='port to host the server on (default: 7447)')
+    parser.add_argument('--no-public-ip', dest='public_ip', action='store_false',
+        help='do not try to determine the public IP of the server')
+    parser.add_argument('--engine', default='threads', choices=['threads', 'asyncio'],
+        help='server engine to use (default: %(default)s)')
+    parser.add_argument('--cache-size', type=int, default=64, metavar='MB',
+        help='memory to use for caching small files in the server, 0 to disable '
+        '(default: %(default)s)')
     parser.add_argument('-d', '--image-dir', default='', metavar='DIR',
         help='directory to scan for images (default: current dir)')
     parser.add_argument('-w', '--watch', type=int, default=False, const=30, nargs='?',
         metavar='SEC', help='filesystem watch interval in seconds (default: %(default)s)')
+    parser.add_argument('--poll', action='store_true',
+        help='poll for changes in watch mode instead of using inotify')
     parser.add_argument('-n', '--pagination', type=int, default=200, metavar='ITEMS',
         help='number of items to display per page (default: %(default)s)')
+    parser.add_argument('--grid', action='store_true',
+        help='show each album on a single scrolling page instead of paginating')
     parser.add_argument('-g', '--group', type=int, default=None, metavar='ITEMS',
         help='number of items to group together (default: %(default)s)')
     parser.add_argument('-o', '--order', default='name', metavar='ORDER',
@@ -379,19 +1543,43 @@ def make_parser() -> argparse.ArgumentParser:
         help='image listing order: name (default), random, or original')
     parser.add_argument('--thumb-dir', default='shis', metavar='DIR',
         help='directory to store generated website (default: %(default)s)')
+    parser.add_argument('--sprites', action='store_true',
+        help='combine the thumbnails of each page into sprite sheets')
+    parser.add_argument('--pack', action='store_true',
+        help='store the thumbnails of each album in a single pack file')
+    parser.add_argument('--dedup', action='store_true',
+        help='thumbnail identical images only once and link the rest')
     parser.add_argument('--previews', action='store_true',
         help='also generate fullscreen previews (takes more time)')
-    parser.add_argument('--ncpus', type=int, default=cpu_count(), metavar='CPUS',
+    parser.add_argument('--ncpus', type=int, default=os.cpu_count(), metavar='CPUS',
         help='number of workers to spawn (default: all available CPUs)')
+    parser.add_argument('--scan-threads', type=int, default=1, metavar='THREADS',
+        help='number of threads to scan directories with (default: %(default)s)')
     parser.add_argument('--thumb-size', type=int, default=256, metavar='SIZE',
         help='size of generated thumbnails in pixels (default: %(default)s)')
     parser.add_argument('--preview-size', type=int, default=1024, metavar='SIZE',
         help='size of generated previews in pixels (default: %(default)s)')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[], metavar='SIZE',
+        help='additional thumbnail sizes in pixels for high density displays')
+    parser.add_argument('--thumb-format', default='source', metavar='FORMAT',
+        choices=['source', *thumb_formats],
+        help='format of generated thumbnails: source (default), jpeg, webp, or avif')
+    parser.add_argument('--quality', type=int, default=None, metavar='QUALITY',
+        help='quality of generated thumbnails from 0 to 100 (default: encoder default)')
+    parser.add_argument('--preset', default='balanced', metavar='PRESET',
+        choices=list(PRESETS),
+        help='thumbnail speed/quality tradeoff: fast, balanced (default), or quality')
+    parser.add_argument('--stats', default=None, metavar='FILE',
+        help='write timings of each stage and the slowest images to FILE as JSON')
     return parser
 
 
 if __name__ == '__main__':
     parser = make_parser()
     args = parser.parse_args()
+    if args.pack and not pack.SUPPORTED:
+        parser.error('--pack is not supported on this platform')
+    if args.engine == 'asyncio' and sys.version_info < (3, 8):
+        parser.error('--engine asyncio requires Python 3.8 or above')
     args.quiet = False
     main(args)
@@ -0,0 +1,111 @@
+import json
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Tuple
+
+from shis.utils import atomic_write
+
+
+class Stats:
+    """Timings collected while generating the website.
+
+    Stages such as scanning and rendering record their total wall-clock
+    time with :meth:`stage`. Stages may be nested, for instance reading
+    image headers is a part of rendering. Every image processed by
+    :func:`~shis.server.generate_thumbnail` records how long it took to
+    decode, resize, encode and save, and how many bytes were read and
+    written, with :meth:`add_image`. Only totals and the slowest images are
+    kept, so memory use does not grow with the number of images.
+
+    Statistics accumulate over every cycle in watch mode, and are written
+    to :attr:`args.stats` as JSON by :meth:`write`.
+
+    :param max_slowest: the number of slowest images to keep.
+    """
+
+    # Steps of generate_thumbnail which are timed separately
+    STEPS = ['decode', 'resize', 'encode', 'save', 'placeholder']
+
+    def __init__(self, max_slowest: int=20):
+        self.max_slowest = max_slowest
+        self.lock = threading.Lock()
+        self.stages = {}  # type: Dict[str, List[float]]
+        self.seconds = dict.fromkeys(self.STEPS, 0.0)
+        self.bytes = {'read': 0, 'written': 0}
+        self.images = 0
+        self.errors = 0
+        self.slowest = []  # type: List[Tuple[float, int, Dict]]
+        self._counter = itertools.count()
+
+    @contextmanager
+    def stage(self, name: str) -> Generator[None, None, None]:
+        """Time a stage of the pipeline.
+
+        :param name: the name of the stage.
+        :return: a context manager timing its block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        """Add the duration of a single run of a stage.
+
+        :param name: the name of the stage.
+        :param seconds: the time taken by the stage.
+        """
+        with self.lock:
+            totals = self.stages.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def add_image(self, path: str, timings: Dict, error: bool=False) -> None:
+        """Add the timings of an image processed by :func:`generate_thumbnail`.
+
+        :param path: the absolute path of the original image.
+        :param timings: the timings filled in by :func:`generate_thumbnail`.
+        :param error: whether the image could not be processed.
+        """
+        record = {'path': path,
+                  'seconds': sum(timings.get(step, 0.0) for step in self.STEPS)}
+        record.update(timings)
+        with self.lock:
+            self.images += 1
+            self.errors += error
+            for step in self.STEPS:
+                self.seconds[step] += timings.get(step, 0.0)
+            self.bytes['read'] += timings.get('bytes_read', 0)
+            self.bytes['written'] += timings.get('bytes_written', 0)
+            item = (record['seconds'], next(self._counter), record)
+            if len(self.slowest) < self.max_slowest:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def report(self) -> Dict:
+        """Summarize everything recorded so far.
+
+        :return: an object which can be encoded as JSON.
+        """
+        with self.lock:
+            return {
+                'stages': {name: {'seconds': seconds, 'count': count}
+                           for name, (seconds, count) in self.stages.items()},
+                'images': {'count': self.images, 'errors': self.errors,
+                           'seconds': dict(self.seconds),
+                           'bytes': dict(self.bytes)},
+                'slowest': [record for *_, record in
+                            sorted(self.slowest, reverse=True)],
+            }
+
+    def write(self, path: str) -> None:
+        """Write :meth:`report` to a file as JSON.
+
+        :param path: the file to write to.
+        """
+        atomic_write(path, json.dumps(self.report(), indent=2) + '\n')
@@ -0,0 +1,200 @@
+// Render an album from index.json, only creating elements for visible rows
+
+(function () {
+
+    const media = document.getElementById('media');
+    const revpath = media.dataset.revpath;
+    const version = media.dataset.version;
+    // Border and margin of each item in pixels, see #media.grid in style.css
+    const BORDER = 8;
+    const MARGIN = 8;
+    // Rows within this many pixels of the viewport are rendered too
+    const BUFFER = 1500;
+
+    let album = null;
+    let rows = [];
+    let rendered = [-1, -1];
+    let pending = false;
+
+    function escape(text) {
+        return String(text).replace(/[&<>"']/g, function (c) {
+            return '&#' + c.charCodeAt(0) + ';';
+        });
+    }
+
+    function link(path) {
+        return revpath + '/' + path.split('/').map(encodeURIComponent).join('/');
+    }
+
+    function file(ref) {
+        return link(album.roots[ref[0]] + '/' + ref[1]);
+    }
+
+    // Breadcrumbs and nested albums
+
+    function renderHeader() {
+        document.title = album.name;
+        const title = document.querySelector('header h1 a');
+        title.textContent = album.name;
+        document.getElementById('breadcrumbs').innerHTML = album.crumbs.map(
+            function (crumb) {
+                return '<a class="breadcrumb-item" href="' + escape(link(crumb.url)) +
+                    '">' + escape(crumb.name) + '</a>';
+            }).join('&nbsp;/&nbsp;');
+        document.getElementById('albums').innerHTML = album.albums.map(
+            function (sub) {
+                const image = sub.image ? link(sub.image) + '?v=' + sub.version : '';
+                return '<a href="' + escape(link(sub.url)) + '" style="background-image: url(\'' +
+                    escape(image) + '\')"><div class="info"><h3>' + escape(sub.name) +
+                    '</h3><div class="summary">' + sub.size + ' items</div></div></a>';
+            }).join('');
+    }
+
+    // Rows are laid out once, and again whenever the width changes
+
+    function layout() {
+        const width = media.clientWidth;
+        let row = null;
+        let x = 0;
+        let y = 0;
+        rows = [];
+        album.thumbs.forEach(function (thumb, idx) {
+            const w = thumb[1] + 2 * BORDER;
+            const h = thumb[2] + 2 * BORDER;
+            const group = album.group && idx % album.group === 0;
+            if (!row || group || (x > 0 && x + w > width)) {
+                if (row) {
+                    y += row.height + MARGIN;
+                }
+                row = { start: idx, end: idx, y: y, height: 0, x: [] };
+                rows.push(row);
+                x = 0;
+            }
+            row.x.push(x);
+            row.end = idx + 1;
+            row.height = Math.max(row.height, h);
+            x += w + MARGIN;
+        });
+        media.style.height = (row ? y + row.height : 0) + 'px';
+        rendered = [-1, -1];
+        render();
+    }
+
+    function findRow(y) {
+        let lo = 0;
+        let hi = rows.length;
+        while (lo < hi) {
+            const mid = (lo + hi) >> 1;
+            if (rows[mid].y + rows[mid].height < y) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        return lo;
+    }
+
+    function item(idx, x, y) {
+        const thumb = album.thumbs[idx];
+        const name = escape(thumb[0]);
+        const v = '?v=' + thumb[3];
+        const srcset = thumb[7].map(function (src) {
+            return file(src) + v + ' ' + src[2] + 'w';
+        }).join(', ');
+        return '<li style="left: ' + x + 'px; top: ' + y + 'px">' +
+            '<div class="overlay overlay-left">' + (idx + 1) + '</div>' +
+            '<div class="overlay overlay-right">' +
+            '<a href="' + escape(file(thumb[5]) + v) + '" class="lg-selector" data-index="' + idx + '">' +
+            '<img src="' + revpath + '/static/expand.svg?v=' + version + '" title="Open in gallery view" /></a>' +
+            '<a target="_blank" href="' + escape(file(thumb[6])) + '">' +
+            '<img src="' + revpath + '/static/external.svg?v=' + version + '" title="Open in a new tab" /></a>' +
+            '</div>' +
+            '<img src="' + escape(file(thumb[4]) + v) + '" loading="lazy" width="' + thumb[1] +
+            '" height="' + thumb[2] + '"' + (thumb[8] ? ' class="placeholder" style="background-image: url(\'' +
+            thumb[8] + '\')"' : '') +
+            (srcset ? ' sizes="' + thumb[1] + 'px" srcset="' + escape(srcset) + '"' : '') + ' />' +
+            '<div class="info">' + name + '</div></li>';
+    }
+
+    function render() {
+        pending = false;
+        if (!rows.length) {
+            media.innerHTML = '';
+            return;
+        }
+        const top = -media.getBoundingClientRect().top;
+        const first = findRow(top - BUFFER);
+        const last = Math.min(findRow(top + window.innerHeight + BUFFER), rows.length - 1);
+        if (first === rendered[0] && last === rendered[1]) {
+            return;
+        }
+        rendered = [first, last];
+        let html = '';
+        for (let r = first; r <= last; r++) {
+            const row = rows[r];
+            for (let idx = row.start; idx < row.end; idx++) {
+                html += item(idx, row.x[idx - row.start], row.y);
+            }
+        }
+        media.innerHTML = html;
+    }
+
+    function schedule() {
+        if (!pending) {
+            pending = true;
+            window.requestAnimationFrame(render);
+        }
+    }
+
+    // The gallery covers the whole album, not only the rendered rows
+
+    function openGallery(index) {
+        const $gallery = $('<div>');
+        $gallery.lightGallery({
+            dynamic: true,
+            dynamicEl: album.thumbs.map(function (thumb) {
+                return {
+                    src: file(thumb[5]) + '?v=' + thumb[3],
+                    subHtml: escape(thumb[0]),
+                    downloadUrl: file(thumb[6])
+                };
+            }),
+            index: index,
+            speed: 0,
+            backdropDuration: 0,
+            slideEndAnimatoin: false,
+            startClass: '',
+            zoom: true,
+            preload: 5
+        });
+        $gallery.on('onCloseAfter.lg', function () {
+            $gallery.data('lightGallery').destroy(true);
+        });
+    }
+
+    $(media).on('click', '.lg-selector', function (event) {
+        event.preventDefault();
+        openGallery(Number(this.dataset.index));
+    });
+
+    let width = 0;
+    window.addEventListener('scroll', schedule, { passive: true });
+    window.addEventListener('resize', function () {
+        if (album && media.clientWidth !== width) {
+            width = media.clientWidth;
+            layout();
+        } else {
+            schedule();
+        }
+    });
+
+    fetch('index.json').then(function (response) {
+        return response.json();
+    }).then(function (data) {
+        album = data;
+        renderHeader();
+        width = media.clientWidth;
+        layout();
+    });
+
+})();
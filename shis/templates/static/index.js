@@ -2,7 +2,8 @@
 
 $(document).ready(function () {
 
-    $("#media").lightGallery({
+    // grid.js opens the gallery of albums shown as a grid
+    $("#media:not(.grid)").lightGallery({
         speed: 0,
         toogleThumb: false,
         backdropDuration: 0,
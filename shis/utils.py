@@ -1,13 +1,33 @@
 import os
 import sys
+import gzip
+import time
+import shutil
+import hashlib
 import argparse
-import urllib.request
+import tempfile
+from contextlib import contextmanager
 from functools import partial
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from threading import Thread
-from typing import Generator, List, Tuple
+from typing import IO, Callable, Generator, List, Optional, Tuple, Union
 
-from tqdm import tqdm
+from shis.pack import pack_store
+from shis.response import COMPRESSIBLE, Resolver, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Functions called with the path of every file replaced by atomic_open
+replace_hooks = []  # type: List[Callable[[str], None]]
+
+# Extensions and compression functions of precompressed copies
+ENCODERS = [('.gz', lambda data: gzip.compress(data, 9))]
+if brotli is not None:
+    ENCODERS.append(('.br', brotli.compress))
 
 
 #-------------------------------------------------------------------------------
@@ -38,6 +58,24 @@ def rreplace(string: str, find: str, replace: str) -> str:
     return replace.join(string.rsplit(find, 1))
 
 
+def slugify(path: str, image_dir: str) -> Tuple[str, str]:
+    """Create a slug for a directory inside :attr:`image_dir`.
+
+    :param path: the absolute path of a directory inside :attr:`image_dir`.
+    :param image_dir: the directory scanned for images.
+    :return: a tuple of (slug_name, slug_path).
+
+        - **slug_name** (*str*) - the path of the directory relative to the
+          parent of :attr:`image_dir`, used as a display name.
+        - **slug_path** (*str*) - the same path with the name of
+          :attr:`image_dir` replaced by ``html``.
+    """
+    image_head, image_tail = os.path.split(image_dir)
+    slug_name = os.path.relpath(path, image_head)
+    slug_path = rreplace(slug_name, image_tail, 'html')
+    return slug_name, slug_path
+
+
 def urlify(slug: str, page=1) -> str:
     """Create a URL given a :attr:`slug` and a :attr:`page` index.
 
@@ -59,30 +97,207 @@ def filter_image(name: str) -> bool:
     :return: ``True`` if the file name is an image, ``False`` otherwise.
     """
     _, ext = os.path.splitext(name)
-    if ext.lower() in ['.jpeg', '.jpg', '.png', '.tiff']:
+    if ext.lower() in ['.jpeg', '.jpg', '.png', '.tiff', '.webp', '.avif']:
         return True
     return False
 
 
-def find_thumb(album_path: str, image_root: str, thumb_dir: str) -> str:
-    """Finds the first available image in a directory.
+# File extensions for each value of args.thumb_format, the first of which
+# is appended to the names of thumbnails which need to be converted.
+THUMB_FORMATS = {
+    'jpeg': ['.jpg', '.jpeg'],
+    'webp': ['.webp'],
+    'avif': ['.avif'],
+}
 
-    :param album_path: the directory to scan.
-    :param image_root: the path to thumbnails of images in :attr:`album_path`.
-    :param thumb_dir: the path to the generated website.
-    :return: relative path to an image in :attr:`album_path` if it
-        exists, empty string otherwise.
+
+def thumb_name(name: str, thumb_format: str) -> str:
+    """Get the file name of the thumbnail of an image.
+
+    If :attr:`thumb_format` is ``source``, or if the image already has the
+    right extension, the name is left as is. Otherwise, the extension of
+    :attr:`thumb_format` is appended, so ``image.png`` becomes
+    ``image.png.webp``.
+
+    :param name: the file name of the original image.
+    :param thumb_format: the format of the thumbnail.
+    :return: the file name of the thumbnail.
     """
-    image = ''
-    for root, _, files in os.walk(album_path):
-        for name in files:
+    if thumb_format == 'source':
+        return name
+    exts = THUMB_FORMATS[thumb_format]
+    _, ext = os.path.splitext(name)
+    if ext.lower() in exts:
+        return name
+    return name + exts[0]
+
+
+def source_name(name: str, thumb_format: str) -> str:
+    """Get the file name of the original image of a thumbnail.
+
+    This is the inverse of :func:`thumb_name`.
+
+    :param name: the file name of the thumbnail.
+    :param thumb_format: the format of the thumbnail.
+    :return: the file name of the original image.
+    """
+    if thumb_format == 'source':
+        return name
+    root, ext = os.path.splitext(name)
+    if ext.lower() == THUMB_FORMATS[thumb_format][0] and filter_image(root):
+        return root
+    return name
+
+
+@contextmanager
+def atomic_open(path: str, mode: str='wb') -> Generator[IO, None, None]:
+    """Open a file for writing such that it is replaced atomically.
+
+    The data is first written to a temporary file in the same directory,
+    which is then renamed to :attr:`path` once the block exits. Readers
+    will either see the old file or the new one, but never a partially
+    written file. If the block raises, :attr:`path` is left untouched.
+    Every function in :data:`replace_hooks` is called with :attr:`path`
+    once it has been replaced.
+
+    :param path: the file to write to.
+    :param mode: the mode to open the temporary file with.
+    :return: a context manager yielding the temporary file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for hook in replace_hooks:
+        hook(path)
+
+
+def atomic_write(path: str, data: Union[str, bytes]) -> None:
+    """Write :attr:`data` to :attr:`path` atomically.
+
+    :param path: the file to write to.
+    :param data: the contents of the file.
+    """
+    with atomic_open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+
+
+def atomic_link(src: str, dst: str) -> None:
+    """Replace :attr:`dst` with a hard link to :attr:`src` atomically.
+
+    If a hard link cannot be created, for instance because the files are
+    on different filesystems, :attr:`src` is copied to :attr:`dst` instead.
+    Every function in :data:`replace_hooks` is called with :attr:`dst`
+    once it has been replaced.
+
+    :param src: the file to link to.
+    :param dst: the file to replace.
+    :raises OSError: if :attr:`src` cannot be read.
+    """
+    tmp_path = os.path.join(os.path.dirname(dst),
+                            f'.tmp-{os.getpid()}-{os.path.basename(dst)}')
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        with open(src, 'rb') as f:
+            atomic_write(dst, f.read())
+        return
+    try:
+        os.replace(tmp_path, dst)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    for hook in replace_hooks:
+        hook(dst)
+
+
+def precompress(path: str) -> None:
+    """Write compressed copies of a file next to it, for the server to send.
+
+    A ``.gz`` copy is always written, and a ``.br`` copy is written too if
+    the ``brotli`` module is available. Each copy gets the same ``mtime``
+    as :attr:`path`, so copies which are already up to date are skipped.
+    Files which are not in :data:`~shis.response.COMPRESSIBLE`, or which
+    do not get any smaller, are left alone.
+
+    :param path: the file to compress.
+    """
+    if os.path.splitext(path)[1].lower() not in COMPRESSIBLE:
+        return
+    stat = os.stat(path)
+    data = None
+    for ext, compress in ENCODERS:
+        copy_path = path + ext
+        try:
+            if os.stat(copy_path).st_mtime_ns == stat.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        if data is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+        compressed = compress(data)
+        if len(compressed) < len(data):
+            atomic_write(copy_path, compressed)
+            os.utime(copy_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        elif os.path.isfile(copy_path):
+            os.remove(copy_path)
+
+
+def hash_dir(path: str) -> str:
+    """Compute a digest of the names and contents of all files in a directory.
+
+    :param path: the directory to hash.
+    :return: a short hex digest, suitable for versioning URLs.
+    """
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
             file_path = os.path.join(root, name)
-            if filter_image(file_path):
-                rel_path = os.path.relpath(file_path, album_path)
-                image_path = os.path.join(image_root, rel_path)
-                image = os.path.relpath(image_path, thumb_dir)
-                return image
-    return image
+            digest.update(os.path.relpath(file_path, path).encode())
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:10]
+
+
+def sync_dir(src: str, dest: str) -> None:
+    """Copy files from :attr:`src` to :attr:`dest` only if they have changed.
+
+    A file is considered to have changed if its size or ``mtime`` differs
+    from the copy in :attr:`dest`. Files are replaced atomically.
+
+    :param src: the directory to copy from.
+    :param dest: the directory to copy to.
+    """
+    for root, _, files in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(dest_root, exist_ok=True)
+        for name in files:
+            src_path = os.path.join(root, name)
+            dest_path = os.path.join(dest_root, name)
+            src_stat = os.stat(src_path)
+            try:
+                dest_stat = os.stat(dest_path)
+                if (dest_stat.st_size == src_stat.st_size and
+                    int(dest_stat.st_mtime) == int(src_stat.st_mtime)):
+                    continue
+            except FileNotFoundError:
+                pass
+            fd, tmp_path = tempfile.mkstemp(dir=dest_root, prefix='.tmp-')
+            os.close(fd)
+            try:
+                shutil.copy2(src_path, tmp_path)
+                os.replace(tmp_path, dest_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
 
 def scale_dims(width: int, height: int, min_val: int) -> Tuple[int, int]:
     """Scales :attr:`width` and :attr:`height` according to :attr:`min_val`.
@@ -135,21 +350,46 @@ def fixed_width_formatter(width: int=80) -> argparse.HelpFormatter:
 class CustomHTTPHandler(SimpleHTTPRequestHandler):
     """An HTTP Handler to serve arbitrary directories compatible with Python 3.6.
 
-    This handler uses :attr:`self.server.directory` instead of always using
-    ``os.getcwd()``
+    Requests are resolved by :attr:`self.server.resolver`, a
+    :class:`~shis.response.Resolver` which serves :attr:`args.thumb_dir`
+    instead of always using ``os.getcwd()``.
 
     :meta private:
     """
 
     protocol_version = "HTTP/1.1"
-
-    def translate_path(self, path: str) -> str:
-        """Translates a path to the local filename syntax."""
-        path = SimpleHTTPRequestHandler.translate_path(self, path)
-        if hasattr(self.server, 'directory'):
-            relpath = os.path.relpath(path, os.getcwd())
-            path = os.path.join(self.server.directory, relpath)
-        return path
+    # Headers and body are written separately, which stalls keep-alive
+    # connections on delayed ACKs unless TCP_NODELAY is set
+    disable_nagle_algorithm = True
+
+    def send_head(self) -> Optional[Response]:
+        """Send the response headers produced by :attr:`self.server.resolver`.
+
+        :return: the response to pass on to :meth:`copyfile`, or ``None``.
+        """
+        start = time.perf_counter()
+        resolver = self.server.resolver
+        path = resolver.translate_path(self.path)
+        resolver.notify(path)
+        response = resolver.respond(self.path, path, self.headers)
+        resolver.track(response, start)
+        self.send_response(response.status)
+        for name, value in response.headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if not response.segments:
+            response.close()
+            return None
+        return response
+
+    def copyfile(self, source: Response, outputfile: IO[bytes]) -> None:
+        """Send the segments of a response, using ``sendfile`` for files."""
+        for segment in source.segments:
+            if not isinstance(segment, tuple):
+                outputfile.write(segment)
+            else:
+                outputfile.flush()
+                self.connection.sendfile(source.file, *segment)
     
     def log_message(self, format: str, *args: str) -> None:
         """A dummy function overridden to disable logging."""
@@ -177,6 +417,9 @@ def start_server(args: argparse.Namespace) -> HTTPServer:
     with open(redir_html, 'w') as f:
         f.write(f'<html><head><meta http-equiv="Refresh" '
                 f'content="0; URL=html/"></head></html>')
+    if args.engine == 'asyncio':
+        from shis.aioserver import start_server_async
+        return start_server_async(args)
     if sys.version_info.minor in [6, 7]:
         return start_server_36(args)
     if sys.version_info.minor >= 8:
@@ -186,9 +429,13 @@ def start_server(args: argparse.Namespace) -> HTTPServer:
 def get_public_ip(host: str, port: int) -> Tuple[str, int]:
     """Try to determine the public IP of the server.
 
+    This makes up to two requests which time out after 5 seconds each.
+
     :param host: the fallback host to return in case of an error
     :param port: the port to check for public availability
     """
+    import urllib.request
+    from http.client import HTTPException
     try:
         with urllib.request.urlopen('https://api.ipify.org', timeout=5) as r:
             public_host = r.read().decode('utf-8')
@@ -197,11 +444,60 @@ def get_public_ip(host: str, port: int) -> Tuple[str, int]:
             status = r.getcode()
         if status == 200:
             host = public_host
-    except urllib.error.URLError:
+    except (OSError, HTTPException):
         pass
     return host, port
 
 
+def announce(httpd: HTTPServer, args: argparse.Namespace, engine: str='') -> None:
+    """Print the address of a server which has just started.
+
+    The public IP of the server is determined in a background thread
+    using :func:`get_public_ip`, and printed as well if the server can be
+    reached on it. This way, starting the server never waits on the
+    network. Set :attr:`args.public_ip` to ``False`` to skip this.
+
+    :param httpd: the server which has started.
+    :param args: preprocessed command line arguments.
+    :param engine: a description of the server engine, if any.
+    """
+    from tqdm import tqdm
+    host, port = httpd.socket.getsockname()[:2]
+    tqdm.write(f"Serving HTTP on {host}:{port}{engine}. "
+               f"Press CTRL-C to quit.")
+
+    def announce_public_ip() -> None:
+        public_host, _ = get_public_ip(host, port)
+        if public_host != host:
+            tqdm.write(f"Serving HTTP on {public_host}:{port} as well.")
+
+    if getattr(args, 'public_ip', True):
+        Thread(target=announce_public_ip, daemon=True).start()
+
+
+def make_resolver(args: argparse.Namespace) -> Resolver:
+    """Create the :class:`~shis.response.Resolver` which serves the website.
+
+    If :attr:`args.pack` is set, thumbnails are served from their pack
+    files, and download links are served directly from :attr:`args.image_dir`
+    since there are no symlinks to the original images. Only images are
+    served from :attr:`args.image_dir`, see :func:`filter_image`. The
+    :class:`~shis.index.ImageIndex` is never served, since it contains the
+    paths of all original images.
+
+    :param args: preprocessed command line arguments.
+    """
+    # shis.index depends on this module through shis.stats
+    from shis.index import ImageIndex
+    resolver = Resolver(args.thumb_dir, args.cache_size << 20)
+    resolver.hidden.append(os.path.join(args.thumb_dir, ImageIndex.NAME))
+    if args.pack:
+        resolver.packs = pack_store(args.thumb_dir)
+        resolver.aliases['full'] = args.image_dir
+        resolver.alias_filter = lambda path: filter_image(os.path.basename(path))
+    return resolver
+
+
 def start_httpd(server: HTTPServer, address: Tuple[str, int], 
     handler: SimpleHTTPRequestHandler, args: argparse.Namespace) -> HTTPServer:
     """Try to start an HTTPServer, choosing the next available port.
@@ -246,14 +542,10 @@ def start_server_36(args):
     server_class = partial(ThreadingHTTPServer, directory=args.thumb_dir)
     server_address = ("", args.port or 7447)
     httpd = start_httpd(server_class, server_address, handler_class, args)
+    httpd.resolver = make_resolver(args)
 
-    Thread(target=httpd.serve_forever).start()
-
-    host, port = httpd.socket.getsockname()
-    host, port = get_public_ip(host, port)
-    serve_message = "Serving HTTP on {host}:{port}. "
-    serve_message += "Press CTRL-C to quit."
-    tqdm.write(serve_message.format(host=host, port=port))
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    announce(httpd, args)
 
     return httpd
 
@@ -279,12 +571,9 @@ def start_server_38(args):
     server_class.address_family, server_address = \
         _get_best_family(None, args.port or 7447)
     httpd = start_httpd(server_class, server_address, handler_class, args)
-    
-    Thread(target=httpd.serve_forever).start()
+    httpd.resolver = make_resolver(args)
 
-    host, port = httpd.socket.getsockname()[:2]
-    host, port = get_public_ip(host, port)
-    tqdm.write(f"Serving HTTP on {host}:{port}. "
-               f"Press CTRL-C to quit.")
+    Thread(target=httpd.serve_forever, daemon=True).start()
+    announce(httpd, args)
 
     return httpd
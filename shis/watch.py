@@ -0,0 +1,164 @@
+import os
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import argparse
+import time
+from typing import Dict, Iterable, Optional, Set
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR)
+EVENT = struct.Struct('iIII')
+
+
+class Watcher:
+    """Watch :attr:`args.image_dir` recursively for changes using inotify.
+
+    inotify is accessed through ``ctypes``, so this class is only
+    available on Linux. Note that inotify does not report changes made
+    by other machines on network filesystems.
+
+    :param args: preprocessed command line arguments.
+    :param paths: the directories to watch.
+    :raises OSError: if inotify is unavailable, or if the limit on the
+        number of watches has been reached.
+    """
+
+    def __init__(self, args: argparse.Namespace, paths: Iterable[str]):
+        self.args = args
+        self.watches = {}  # type: Dict[int, str]
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            for path in paths:
+                self.add(path)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, path: str) -> None:
+        """Start watching a single directory.
+
+        :param path: the absolute path of the directory.
+        :raises OSError: if the directory could not be watched.
+        """
+        wd = self._add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+
+    def add_tree(self, path: str) -> Set[str]:
+        """Start watching a directory and all its subdirectories.
+
+        :param path: the absolute path of the directory.
+        :return: the set of directories which were added.
+        """
+        added = set()
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            if self.args.thumb_dir in path:
+                continue
+            self.add(path)
+            added.add(path)
+            try:
+                with os.scandir(path) as entries:
+                    pending.extend(entry.path for entry in entries
+                        if entry.is_dir() and not entry.is_symlink())
+            except OSError:
+                pass
+        return added
+
+    def read(self) -> Optional[Set[str]]:
+        """Read all pending events without blocking.
+
+        :return: the set of directories whose contents have changed, or
+            ``None`` if events were lost and the whole tree must be scanned.
+        """
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                root = self.watches.get(wd)
+                if root is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    changed.add(root)
+                    continue
+                path = os.path.join(root, os.fsdecode(name))
+                if self.args.thumb_dir in path:
+                    continue
+                changed.add(root)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.add_tree(path))
+
+    def wait(self, debounce: float=1.0) -> Optional[Set[str]]:
+        """Block until something changes, then wait for things to settle.
+
+        Bursts of events are collected until no new events arrive for
+        :attr:`debounce` seconds.
+
+        :param debounce: the number of seconds to wait for more events.
+        :return: the set of directories whose contents have changed, or
+            ``None`` if the whole tree must be scanned again.
+        :raises OSError: if the limit on the number of watches is reached.
+        """
+        select.select([self.fd], [], [])
+        changed = set()
+        deadline = time.monotonic() + debounce * 10
+        while True:
+            events = self.read()
+            if events is None:
+                return None
+            changed |= events
+            timeout = min(debounce, deadline - time.monotonic())
+            if timeout <= 0 or not select.select([self.fd], [], [], timeout)[0]:
+                return changed
+
+    def close(self) -> None:
+        """Stop watching and release the inotify instance."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+from http import HTTPStatus
+
+from shis.index import ImageIndex
+from shis.server import make_parser, preprocess_args
+from shis.utils import make_resolver, precompress
+
+
+class ResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.thumb_dir = os.path.join(self.tmp.name, 'shis')
+        os.makedirs(self.thumb_dir)
+        args = preprocess_args(make_parser().parse_args(
+            ['-d', self.tmp.name, '--thumb-dir', self.thumb_dir]))
+        self.resolver = make_resolver(args)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def get(self, target, headers=None):
+        path = self.resolver.translate_path(target)
+        return self.resolver.respond(target, path, headers or {})
+
+    def test_index_is_not_served(self):
+        index = ImageIndex(self.thumb_dir)
+        index.conn.execute('SELECT 1')
+        for suffix in ['', '-wal', '-shm', '-journal']:
+            with open(index.path + suffix, 'ab'):
+                pass
+            response = self.get('/' + ImageIndex.NAME + suffix)
+            self.assertEqual(response.status, HTTPStatus.NOT_FOUND)
+        response = self.get('/')
+        self.assertEqual(response.status, HTTPStatus.OK)
+        listing = b''.join(response.segments)
+        self.assertNotIn(ImageIndex.NAME.encode(), listing)
+        index.close()
+
+    def test_stale_copy_is_not_served(self):
+        html = os.path.join(self.thumb_dir, 'page.html')
+        with open(html, 'w') as f:
+            f.write('old ' * 100)
+        precompress(html)
+        headers = {'Accept-Encoding': 'gzip'}
+        response = self.get('/page.html', headers)
+        self.assertIn(('Content-Encoding', 'gzip'), response.headers)
+        response.close()
+        with open(html, 'w') as f:
+            f.write('new ' * 100)
+        os.utime(html, ns=(0, os.stat(html).st_mtime_ns + 1))
+        response = self.get('/page.html', headers)
+        self.assertNotIn(('Content-Encoding', 'gzip'), response.headers)
+        self.assertEqual(b''.join(response.segments), b'new ' * 100)
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
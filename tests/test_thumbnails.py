@@ -0,0 +1,55 @@
+import os
+import tempfile
+import unittest
+
+from PIL import Image
+
+from shis.server import generate_thumbnail, make_parser, preprocess_args, size_path
+from shis.utils import scale_dims
+
+
+class GenerateThumbnailTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image_dir = os.path.join(self.tmp.name, 'images')
+        self.thumb_dir = os.path.join(self.tmp.name, 'shis')
+        os.makedirs(self.image_dir)
+        self.in_file = os.path.join(self.image_dir, 'image.jpg')
+        Image.new('RGB', (1200, 800), 'red').save(self.in_file)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def generate(self, *argv):
+        args = preprocess_args(make_parser().parse_args(
+            ['-d', self.image_dir, '--thumb-dir', self.thumb_dir, *argv]))
+        paths = tuple(os.path.join(self.thumb_dir, kind, 'image.jpg')
+                      for kind in ['small', 'large', 'full'])
+        out_files = [paths[0], *(size_path(args, paths[0], size)
+                                 for size in args.sizes)]
+        for out_file in [*paths, *out_files]:
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+        result = generate_thumbnail((self.in_file, *paths), args)
+        self.assertNotIsInstance(result, Exception)
+        return args, paths
+
+    def assertSize(self, path, size):
+        with Image.open(path) as im:
+            self.assertEqual(im.size, scale_dims(1200, 800, size))
+
+    def test_sizes_below_thumb_size(self):
+        args, (small_file, _, _) = self.generate('--sizes', '128', '512')
+        self.assertSize(small_file, args.thumb_size)
+        for size in args.sizes:
+            self.assertSize(size_path(args, small_file, size), size)
+
+    def test_preview_below_thumb_size(self):
+        args, (small_file, large_file, _) = self.generate(
+            '--previews', '--preview-size', '128')
+        self.assertSize(small_file, args.thumb_size)
+        self.assertSize(large_file, 128)
+
+
+if __name__ == '__main__':
+    unittest.main()